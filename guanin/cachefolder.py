@@ -0,0 +1,35 @@
+'''
+Folders of the on-disk caches. Cache entries are unpickled or unpacked as they are, so they are only read from
+folders no other user can write to.
+'''
+import os
+import pathlib
+import stat
+
+
+def usercachedir(name):
+    '''Default folder of cache name, in the user cache folder ($XDG_CACHE_HOME, ~/.cache or %LOCALAPPDATA%)'''
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or pathlib.Path.home() / 'AppData' / 'Local'
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+    return pathlib.Path(base) / 'guanin' / name
+
+
+def privatefolder(folder):
+    '''
+    Creates folder (mode 0700) if missing and tells if it is safe to read cache entries from it: a directory,
+    not a symlink, owned by the current user and not writable by group or others
+    '''
+    folder = pathlib.Path(folder)
+    try:
+        folder.mkdir(mode=0o700, parents=True, exist_ok=True)
+        info = os.lstat(folder)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(info.st_mode):
+        return False
+    if not hasattr(os, 'getuid'):
+        #no POSIX owners, folder ACLs are left to the system
+        return True
+    return info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
@@ -0,0 +1,175 @@
+'''Calibration curves of the positive controls, used to correct counts by regression'''
+import json
+
+import numpy as np
+import pandas as pd
+from numpy.polynomial import polyutils
+from scipy.stats.mstats import gmean
+
+
+def cubicroots(coef):
+    '''
+    Roots of many polynomials of degree 1 to 3 at once, in closed form and polished with a Newton step.
+
+    :param coef: array polynomials x (degree + 1), lowest degree first, highest one not 0
+    :return: complex array polynomials x degree
+    '''
+    coef = np.asarray(coef, dtype=complex)
+    degree = coef.shape[1] - 1
+    if degree == 1:
+        return -coef[:, :1]/coef[:, 1:]
+    if degree == 2:
+        c, b, a = coef.T
+        #the root without cancellation, the other one from their product
+        sqrtdisc = np.sqrt(b*b - 4*a*c)
+        sqrtdisc = np.where((np.conj(b)*sqrtdisc).real < 0, -sqrtdisc, sqrtdisc)
+        q = -(b + sqrtdisc)/2
+        safe = np.where(q == 0, 1, q)
+        roots = np.column_stack([np.where(q == 0, 0, q/a), np.where(q == 0, 0, c/safe)])
+    else:
+        d, c, b, a = (coef/coef[:, 3:]).T
+        #depressed cubic t**3 + p*t + q, x = t - b/3, by Cardano
+        p = c - b*b/3
+        q = 2*b**3/27 - b*c/3 + d
+        sqrtdisc = np.sqrt(q*q/4 + p**3/27)
+        w = -q/2 + np.where((np.conj(q)*sqrtdisc).real > 0, -sqrtdisc, sqrtdisc)
+        u = w**(1/3)
+        third = np.exp(2j*np.pi/3)**np.arange(3)
+        uk = u[:, None]*third
+        safe = np.where(uk == 0, 1, uk)
+        roots = np.where(uk == 0, 0, uk - (p[:, None]/3)/safe) - b[:, None]/3
+    #Newton step, kept only where it gets closer to a root
+    poly = np.zeros_like(roots)
+    slope = np.zeros_like(roots)
+    for i in coef.T[::-1]:
+        slope = slope*roots + poly
+        poly = poly*roots + i[:, None]
+    step = roots - poly/np.where(slope == 0, 1, slope)
+    polished = np.zeros_like(roots)
+    for i in coef.T[::-1]:
+        polished = polished*step + i[:, None]
+    return np.where((slope != 0) & (np.abs(polished) < np.abs(poly)), step, roots)
+
+
+def polyinverse(poly, values, near):
+    '''
+    For each value, the root of poly(x) - value nearest to near, in absolute value. The same as
+    abs(min((poly - value).roots(), key=lambda x: abs(x - near))) for all values at once: roots of the degree 3 (or
+    lower) calibration curves come in closed form (cubicroots), higher degrees from the eigenvalues of stacked
+    companion matrices, as Polynomial.roots() gets them.
+
+    :param poly: numpy Polynomial
+    :param values: array of values of poly to invert
+    :param near: array of guesses, the root closest to each one is returned
+    '''
+    values = np.asarray(values, dtype=float)
+    near = np.asarray(near, dtype=float)
+    coef = polyutils.trimcoef(poly.coef, 0) if poly.coef[-1] == 0 else poly.coef
+    degree = len(coef) - 1
+    off, scl = polyutils.mapparms(poly.window, poly.domain)
+
+    if degree <= 3:
+        shifted = np.tile(coef, (len(values), 1))
+        shifted[:, 0] -= values
+        roots = cubicroots(shifted)
+    else:
+        companion = np.zeros((len(values), degree, degree))
+        companion[:, np.arange(1, degree), np.arange(degree - 1)] = 1
+        companion[:, 0, -1] = -((coef[0] - values)/coef[-1])
+        companion[:, 1:, -1] = -(coef[1:-1]/coef[-1])
+        roots = np.linalg.eigvals(companion[:, ::-1, ::-1])
+    roots = off + scl*np.sort(roots, axis=1)
+
+    nearest = np.abs(roots - near[:, None]).argmin(axis=1)
+    return np.abs(roots[np.arange(len(values)), nearest])
+
+
+#concentrations of the positive controls, lowest to highest, counts are fit to them
+YMEAN = [31, 125, 500, 2000, 8000, 32000]
+
+
+def fitcubics(x, y):
+    '''
+    Least squares cubics y = f(x) for many curves at once, as np.polynomial.Polynomial.fit(x[i], y, 3) fits each.
+
+    :param x: array curves x points
+    :return: (coefficients in the fit window, curves x 4; fit domains, curves x 2)
+    '''
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    y = np.asarray(y, dtype=float)
+    domains = np.column_stack([x.min(axis=1), x.max(axis=1)])
+    #map x to the window [-1, 1] like Polynomial.fit, then column-scaled least squares like polyfit
+    off, scl = polyutils.mapparms(domains.T, [-1, 1])
+    t = off[:, None] + scl[:, None]*x
+    vander = t[:, :, None]**np.arange(4)
+    norms = np.sqrt(np.square(vander).sum(axis=1))
+    norms[norms == 0] = 1
+    coef = (np.linalg.pinv(vander/norms[:, None, :]) @ y)/norms
+    return coef, domains
+
+
+class CalibrationModel:
+    '''
+    Positive control calibration: a cubic per lane from its sorted positive counts to YMEAN concentrations, and the
+    reference cubic, fit to the geometric mean of each positive control across lanes. correct() takes lane counts
+    to the counts giving the same concentration on the reference curve.
+
+    Lane curves are fit all at once. The model can be saved and loaded, so another batch can be corrected
+    against the same reference curve (see fit(reference=...)).
+    '''
+    def __init__(self, reference, lanes, coef, domains, ymean=YMEAN, source=None):
+        self.reference = reference
+        self.lanes = pd.Index(lanes)
+        self.coef = np.asarray(coef, dtype=float)
+        self.domains = np.asarray(domains, dtype=float)
+        self.ymean = list(ymean)
+        #digest of the positive counts the lane curves come from
+        self.source = source
+
+    @classmethod
+    def fit(cls, posneg, ymean=YMEAN, reference=None, source=None):
+        '''
+        Fits the curves of every lane in posneg (posnegcounts table: controls x lanes, plus a CodeClass column).
+        NEG rows are left out. reference, a CalibrationModel, gives the reference curve instead of these lanes
+        '''
+        positives = posneg.loc[~posneg.index.str.contains('NEG')].drop('CodeClass', axis=1)
+        coef, domains = fitcubics(np.sort(positives.to_numpy(dtype=float), axis=0).T, ymean)
+        if reference is None:
+            xmean = sorted(gmean(positives.to_numpy(dtype=float), axis=1))
+            reference = np.polynomial.Polynomial.fit(xmean, ymean, 3)
+        else:
+            reference = reference.reference
+        return cls(reference, positives.columns, coef, domains, ymean=ymean, source=source)
+
+    def curve(self, lane):
+        '''Calibration curve of lane, a numpy Polynomial'''
+        i = self.lanes.get_loc(lane)
+        return np.polynomial.Polynomial(self.coef[i], domain=self.domains[i])
+
+    def correct(self, lane, counts):
+        '''Counts of lane corrected to the reference curve, the root nearest to each count, see polyinverse'''
+        counts = np.asarray(counts, dtype=float)
+        return polyinverse(self.reference, self.curve(lane)(counts), counts)
+
+    def todict(self):
+        return {
+            'reference': {'coef': self.reference.coef.tolist(), 'domain': self.reference.domain.tolist()},
+            'lanes': self.lanes.tolist(),
+            'coef': self.coef.tolist(),
+            'domains': self.domains.tolist(),
+            'ymean': self.ymean,
+        }
+
+    @classmethod
+    def fromdict(cls, model):
+        reference = np.polynomial.Polynomial(model['reference']['coef'], domain=model['reference']['domain'])
+        return cls(reference, model['lanes'], model['coef'], model['domains'], ymean=model['ymean'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.todict(), f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.fromdict(json.load(f))
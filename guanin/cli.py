@@ -1,10 +1,28 @@
+import sys
+
 from . import guanin
 
 
 def main():
+    if sys.argv[1:2] == ['watch']:
+        return watch(sys.argv[2:])
+    if sys.argv[1:2] == ['apply']:
+        return apply(sys.argv[2:])
     args = guanin.argParser()
     guanin.runQCview(args)
     guanin.runQCfilter(args)
     guanin.technorm(args)
     guanin.contnorm(args)
     guanin.evalnorm(args)
+
+
+def watch(argv=None):
+    '''guanin-cli watch [options]: QC of each new RCC in --folder as soon as the instrument writes it'''
+    args = guanin.argParser(argv)
+    guanin.watchfolder(args)
+
+
+def apply(argv=None):
+    '''guanin-cli apply --normmodel model.json [options]: normalizes the RCCs in --folder against an earlier analysis'''
+    args = guanin.argParser(argv)
+    guanin.runapply(args)
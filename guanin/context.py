@@ -0,0 +1,47 @@
+'''In-memory analysis context, holds the tables stages pass to each other instead of parsing back their csv exports'''
+import pandas as pd
+
+
+def asread(table, index=True, index_col=None):
+    '''table, written with to_csv(index=index), as pd.read_csv(index_col=index_col) returns it'''
+    if index:
+        if table.index.name is None:
+            table.index.name = 'Unnamed: 0'
+        table = table.reset_index()
+    else:
+        table = table.reset_index(drop=True)
+    table.columns = [str(i) for i in table.columns]
+
+    if index_col is not None:
+        if isinstance(index_col, int):
+            index_col = table.columns[index_col]
+        table = table.set_index(index_col)
+        if index_col == 'Unnamed: 0':
+            table.index.name = None
+    return table.infer_objects()
+
+
+class AnalysisContext:
+    '''
+    Tables of an analysis keyed by their output path. get() returns them as read_csv would read the csv
+    written with the same to_csv index option, so readers work the same with tables from memory or disk.
+    '''
+    def __init__(self):
+        self.tables = {}
+
+    def __contains__(self, path):
+        return str(path) in self.tables
+
+    def put(self, path, table, index=True):
+        '''Keeps a copy of table as written to path by to_csv(index=index). Returns the copy, which is never changed'''
+        table = table.copy()
+        self.tables[str(path)] = (table, index)
+        return table
+
+    def get(self, path, index_col=None):
+        '''Copy of the table at path, as pd.read_csv(path, index_col=index_col) would return it'''
+        table, index = self.tables[str(path)]
+        return asread(table.copy(), index=index, index_col=index_col)
+
+    def clear(self):
+        self.tables.clear()
@@ -0,0 +1,114 @@
+'''Background writer for output files, stages keep computing while their tables are formatted and written'''
+import atexit
+import logging
+import os
+import queue
+import shutil
+import threading
+
+
+def filestat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class ExportWriter:
+    '''
+    Writes files from a worker thread. At most maxsize writes wait in the queue, submit() blocks when it is full.
+
+    Writes can carry a digest of their content and format options, or a function computing it on the worker
+    thread so the caller doesn't wait for hashing. A file that already has that content is
+    not rewritten, a file that got it elsewhere is copied instead of formatted again, and a write superseded by
+    a later one to the same file is dropped. flush() waits for all writes and raises the first worker error.
+    '''
+    def __init__(self, maxsize=8):
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.sequence = 0
+        #path: [sequence of its last submit, digest, stat once written]
+        self.files = {}
+        #digest: path of the first file written with it
+        self.sources = {}
+        self.errors = []
+
+    def submit(self, path, write, digest=None, copy=shutil.copyfile):
+        '''
+        Queues write(path).
+
+        :param digest: content digest of the write, or a function giving it, which is then called on the worker
+            thread. None if it can't be deduplicated
+        :param copy: copy(source, path) writes path from a file with the same digest
+        '''
+        path = str(path)
+        with self.lock:
+            entry = self.files.get(path)
+            if digest is not None and entry is not None and entry[1] == digest and entry[2] in (None, filestat(path)):
+                return
+            #digest and stat the file was last written with, for digests the worker computes
+            previous = (entry[1], entry[2]) if entry is not None else (None, None)
+            self.sequence += 1
+            self.files[path] = [self.sequence, None if callable(digest) else digest, None]
+            job = (self.sequence, path, write, digest, copy, previous)
+        self.start()
+        self.queue.put(job)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, name='guanin-export', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def work(self):
+        while True:
+            sequence, path, write, digest, copy, previous = self.queue.get()
+            try:
+                with self.lock:
+                    entry = self.files.get(path)
+                if entry is None or entry[0] != sequence:
+                    #superseded by a later write to path
+                    continue
+                if callable(digest):
+                    digest = digest()
+                    with self.lock:
+                        entry[1] = digest
+                        if previous[0] == digest and previous[1] is not None and previous[1] == filestat(path):
+                            entry[2] = previous[1]
+                            continue
+                with self.lock:
+                    source = self.sources.get(digest) if digest is not None else None
+                    written = self.files.get(source)
+                    if source == path or written is None or written[1] != digest or written[2] is None or written[2] != filestat(source):
+                        source = None
+                if source is not None:
+                    copy(source, path)
+                else:
+                    write(path)
+                with self.lock:
+                    if entry is self.files.get(path):
+                        entry[2] = filestat(path)
+                        if digest is not None:
+                            self.sources[digest] = path
+            except Exception as e:
+                with self.lock:
+                    self.files.pop(path, None)
+                    self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        '''Waits until every submitted file is written. Raises the first error of the writes since last flush'''
+        self.queue.join()
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logging.error('Unable to write some output files: ' + str(e))
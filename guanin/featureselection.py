@@ -0,0 +1,162 @@
+'''
+Reverse (backward) sequential feature selection with a KNN classifier, for ranking genes by how much they
+tell sample groups apart.
+
+Same search as mlxtend's SequentialFeatureSelector(forward=False, floating=False) with a KNeighborsClassifier
+scored by balanced accuracy: starting with all genes, the gene whose removal gives the best cross-validated
+score is dropped at each step (on ties, the last one). But the squared distance between every test and
+train sample is split into one contribution per gene. The distances of a subset are the sum of its
+contributions, and those of every subset one gene smaller come from subtracting that gene's contribution, so
+a whole step is scored with a few array operations instead of one KNN fit per candidate. Contributions are
+computed from the fold samples a block of genes at a time, never for all genes at once. Steps can be spread
+over a process pool and stopped at a time budget.
+'''
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import stats
+from sklearn.model_selection import check_cv
+
+
+#max elements of the candidates x test x train distance blocks scored at once
+BLOCKSIZE = 2**24
+#steps with smaller blocks are scored in process, a pool costs more than it saves
+POOLSIZE = 2**22
+
+
+def foldsamples(X, y, cv=2):
+    '''
+    Test and train samples of each cross validation fold, folds as cross_val_score makes them for a classifier.
+
+    :param X: samples x genes array
+    :param y: group of each sample
+    :return: list of (test x genes, train x genes, test labels, train labels), labels as codes of np.unique(y)
+    '''
+    X = np.asarray(X, dtype=float)
+    codes = np.unique(y, return_inverse=True)[1]
+    folds = []
+    for train, test in check_cv(cv, y, classifier=True).split(X, y):
+        folds.append((X[test], X[train], codes[test], codes[train]))
+    return folds
+
+
+def contributions(fold, genes):
+    '''genes x test x train squared distance contributions of genes between the test and train samples of fold'''
+    Xtest, Xtrain = fold[:2]
+    return np.square(Xtest[:, genes].T[:, :, None] - Xtrain[:, genes].T[:, None, :])
+
+
+def scorefold(fold, subset, candidates, neighbors):
+    '''
+    Balanced accuracy on the test samples of fold of KNN with the genes in subset but each of candidates,
+    or with all of subset if candidates is empty
+    '''
+    Xtest, Xtrain, ytest, ytrain = fold
+    if neighbors > len(ytrain):
+        return np.full(max(len(candidates), 1), np.nan)
+
+    chunk = max(1, BLOCKSIZE // (len(ytest)*len(ytrain)))
+    #added gene after gene in subset order, as a sum over all contributions would
+    total = np.zeros((len(ytest), len(ytrain)))
+    for start in range(0, len(subset), chunk):
+        block = contributions(fold, subset[start:start + chunk])
+        block[0] += total
+        total = block.sum(axis=0)
+    nclasses = max(ytest.max(), ytrain.max()) + 1
+    present = np.unique(ytest)
+    scores = []
+    for start in range(0, max(len(candidates), 1), chunk):
+        if len(candidates):
+            distances = total[None] - contributions(fold, candidates[start:start + chunk])
+        else:
+            distances = total[None]
+        if neighbors < distances.shape[2]:
+            nearest = np.argpartition(distances, neighbors - 1, axis=2)[:, :, :neighbors]
+        else:
+            nearest = np.broadcast_to(np.arange(distances.shape[2]), distances.shape)
+        #uniform votes, ties go to the first group as in KNeighborsClassifier
+        votes = (ytrain[nearest][..., None] == np.arange(nclasses)).sum(axis=2)
+        correct = votes.argmax(axis=2) == ytest
+        #mean recall of the groups in the test samples
+        scores.append(np.mean([correct[:, ytest == i].mean(axis=1) for i in present], axis=0))
+    return np.concatenate(scores)
+
+
+_folds = None
+
+
+def _setfolds(folds):
+    global _folds
+    _folds = folds
+
+
+def _scorechunk(job):
+    fold, subset, candidates, neighbors = job
+    return scorefold(_folds[fold], subset, candidates, neighbors)
+
+
+def backwardselection(X, y, neighbors, cv=2, kfeatures=1, timebudget=None, jobs=1):
+    '''
+    Backward selection of the genes (columns) of X down to kfeatures genes.
+
+    :param neighbors: KNN neighbors
+    :param timebudget: seconds after which no new step is started, None for no limit
+    :param jobs: processes to score candidates with, 0 or None uses all cores
+    :return: dict of subset size: {'feature_idx', 'cv_scores', 'avg_score'}, as mlxtend subsets_
+    '''
+    start = time.monotonic()
+    folds = foldsamples(X, y, cv)
+    if jobs is None or jobs <= 0:
+        jobs = os.cpu_count()
+    pool = ProcessPoolExecutor(max_workers=jobs, initializer=_setfolds, initargs=(folds,)) if jobs > 1 else None
+    _setfolds(folds)
+
+    def score(subset, candidates):
+        '''cv x candidates scores'''
+        if pool is None or len(candidates)*len(folds[0][2])*len(folds[0][3]) < POOLSIZE:
+            return np.array([scorefold(i, subset, candidates, neighbors) for i in folds])
+        #each fold and slice of candidates is a job
+        nchunks = max(1, min(len(candidates), 4*jobs//len(folds)))
+        chunks = np.array_split(candidates, nchunks) if len(candidates) else [candidates]
+        work = [(i, subset, j, neighbors) for i in range(len(folds)) for j in chunks]
+        results = list(pool.map(_scorechunk, work))
+        return np.array([np.concatenate(results[i*len(chunks):(i + 1)*len(chunks)]) for i in range(len(folds))])
+
+    try:
+        subset = np.arange(X.shape[1])
+        cvscores = score(subset, np.empty(0, dtype=int))[:, 0]
+        subsets = {len(subset): {'feature_idx': tuple(subset.tolist()), 'cv_scores': cvscores,
+                                 'avg_score': np.nanmean(cvscores)}}
+        while len(subset) > kfeatures:
+            if timebudget is not None and time.monotonic() - start > timebudget:
+                logging.warning('Feature selection stopped at ' + str(len(subset)) + ' genes, time budget of ' +
+                                str(timebudget) + ' seconds reached')
+                break
+            #mlxtend tries removing the last gene first and keeps the first best
+            candidates = subset[::-1]
+            cvscores = score(subset, candidates)
+            avgscores = np.nanmean(cvscores, axis=0)
+            best = np.argmax(avgscores)
+            subset = np.sort(subset[subset != candidates[best]])
+            subsets[len(subset)] = {'feature_idx': tuple(subset.tolist()), 'cv_scores': cvscores[:, best],
+                                    'avg_score': avgscores[best]}
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return subsets
+
+
+def metricdict(subsets, names, confidence=0.95):
+    '''subsets with gene names and the spread of their cv scores, as mlxtend get_metric_dict'''
+    metrics = {}
+    for k, j in subsets.items():
+        metrics[k] = dict(j)
+        metrics[k]['feature_names'] = tuple(names[i] for i in j['feature_idx'])
+        stderr = stats.sem(j['cv_scores'])
+        metrics[k]['ci_bound'] = stderr*stats.t.ppf((1 + confidence)/2.0, len(j['cv_scores']))
+        metrics[k]['std_dev'] = np.std(j['cv_scores'])
+        metrics[k]['std_err'] = stderr
+    return metrics
@@ -0,0 +1,87 @@
+'''Gene catalogue: genes of a count table mapped to integer ids, with their CodeClass rows'''
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from .qcmetrics import ENDOGENOUSCLASSES, HOUSEKEEPINGCLASSES, NEGATIVECLASSES, POSITIVECLASSES
+
+
+KINDS = {
+    'Endogenous': ENDOGENOUSCLASSES,
+    'Housekeeping': HOUSEKEEPINGCLASSES,
+    'Positive': POSITIVECLASSES,
+    'Negative': NEGATIVECLASSES,
+}
+
+
+class GeneCatalogue:
+    '''
+    Genes of a count table, in table order. The id of a gene is its row position, so rows are selected with
+    .iloc and integer arrays. Names are hashed and CodeClass rows grouped once, when the catalogue is built.
+
+    Tables are matched to the catalogue by the identity of their Name index: names of an index are compared once,
+    then the index is known to have the catalogue genes (or those of a derived catalogue, see forcounts).
+    '''
+    def __init__(self, names, codeclass):
+        self.names = pd.Index(names, name='Name')
+        self.codeclass = np.asarray(codeclass, dtype=object)
+        self.classrows = {i: np.flatnonzero(self.codeclass == i) for i in pd.unique(self.codeclass)}
+        self.masks = {i: np.isin(self.codeclass, j) for i, j in KINDS.items()}
+        #id of a Name index: (weak reference to it, catalogue of its genes)
+        self.indexes = {}
+
+    def __getstate__(self):
+        #known indexes are only meaningful in this process
+        state = dict(self.__dict__)
+        state['indexes'] = {}
+        return state
+
+    @classmethod
+    def fromcounts(cls, counts):
+        '''Catalogue of a count table with Name as index or column and a CodeClass column'''
+        names = counts['Name'] if 'Name' in counts.columns else counts.index
+        return cls(names, counts['CodeClass'])
+
+    def __len__(self):
+        return len(self.names)
+
+    def sameas(self, counts):
+        '''True if counts has the genes of the catalogue in the same order'''
+        return self.forcounts(counts, build=False) is self
+
+    def forcounts(self, counts, build=True):
+        '''
+        Catalogue of the genes of counts: this one if counts keeps its genes in the same order, else a catalogue
+        built for counts, reused for later tables with the same Name index. None if not build and counts has other genes
+        '''
+        names = counts['Name'] if 'Name' in counts.columns else counts.index
+        if isinstance(names, pd.Index):
+            known = self.indexes.get(id(names))
+            if known is not None and known[0]() is names:
+                return known[1]
+        if len(names) == len(self.names) and np.array_equal(np.asarray(names, dtype=object), self.names.values):
+            catalogue = self
+        elif build:
+            catalogue = GeneCatalogue.fromcounts(counts)
+        else:
+            return None
+        if isinstance(names, pd.Index):
+            key = id(names)
+            self.indexes[key] = (weakref.ref(names, lambda ref: self.indexes.pop(key, None)), catalogue)
+        return catalogue
+
+    def ids(self, names):
+        '''Ids of names, all rows of a name if it is repeated. KeyError if some name is not in the catalogue'''
+        ids = self.names.get_indexer_for(names)
+        if (ids < 0).any():
+            raise KeyError('Genes not in catalogue: ' + str([i for i in names if i not in self.names]))
+        return ids
+
+    def rows(self, *codeclasses):
+        '''Ids of the genes of codeclasses, grouped in codeclasses order'''
+        return np.concatenate([self.classrows.get(i, np.empty(0, dtype=int)) for i in codeclasses]).astype(int)
+
+    def kind(self, kind):
+        '''Ids of Endogenous, Housekeeping, Positive or Negative genes (any of their CodeClass variants)'''
+        return np.flatnonzero(self.masks[kind])
@@ -0,0 +1,78 @@
+'''
+geNorm reference gene stability, computed in log space.
+
+The stability M of a gene is the mean standard deviation of its log2 ratios to every other candidate. The
+std of log2(a/b) over samples is sqrt(Var a + Var b - 2 Cov(a, b)) of the log2 expressions, so all pairwise
+stds come from a single covariance matrix instead of one ratio series per pair.
+'''
+import numpy as np
+
+
+def logexpression(df, ctVal=False):
+    '''
+    log2 expression of a samples x genes table, as measureM takes it: counts relative to the gene maximum,
+    or 2**-(Ct - min Ct) for Ct values
+    '''
+    values = np.asarray(df, dtype=float)
+    if ctVal:
+        return -(values - values.min(axis=0))
+    return np.log2(values/values.max(axis=0))
+
+
+def pairwisesd(logs):
+    '''genes x genes matrix of the std (ddof=1) over samples of the log ratio of each pair of genes'''
+    cov = np.cov(logs, rowvar=False, ddof=1)
+    var = np.diag(cov)
+    sd = np.sqrt(np.clip(var[:, None] + var[None, :] - 2*cov, 0, None))
+    #exactly symmetric, so both genes of a pair see the same value
+    sd = (sd + sd.T)/2
+    np.fill_diagonal(sd, 0)
+    return sd
+
+
+def mvalues(logs):
+    '''geNorm M of each gene (column) of a samples x genes log2 expression array'''
+    logs = np.asarray(logs, dtype=float)
+    return pairwisesd(logs).sum(axis=1)/(logs.shape[1] - 1)
+
+
+def elimination(logs):
+    '''
+    Stepwise geNorm ranking of the genes of a samples x genes log2 expression array. The least stable gene
+    (highest M) is dropped until two are left, and the M of the others are updated by taking its pairwise stds
+    out of their sums instead of recomputing them.
+
+    :return: M of every gene among all of them; gene positions in elimination order, the last two being the most
+        stable pair; mean M of the genes left before each elimination, and of the final pair
+    '''
+    sd = pairwisesd(logs)
+    n = sd.shape[0]
+    sums = sd.sum(axis=1)
+    alive = np.ones(n, dtype=bool)
+    m = sums/(n - 1)
+
+    order = []
+    avgm = []
+    for left in range(n, 2, -1):
+        current = np.where(alive, sums/(left - 1), -np.inf)
+        worst = int(np.argmax(current))
+        avgm.append(current[alive].mean())
+        order.append(worst)
+        alive[worst] = False
+        sums -= sd[:, worst]
+
+    pair = np.flatnonzero(alive)
+    order.extend(pair.tolist())
+    avgm.append(sums[alive].mean()/(len(pair) - 1))
+    return m, np.array(order), np.array(avgm)
+
+
+def pairwisevariation(logs, order):
+    '''
+    geNorm pairwise variations V(n/n+1), n = 2 .. genes - 1, of a samples x genes log2 expression array: std of the
+    log2 ratio of the normalization factors (geometric means) of the n and n + 1 most stable genes. order gives the
+    genes from most to least stable, and the log2 geomeans of every n come from one cumulative sum along it
+    '''
+    logs = np.asarray(logs, dtype=float)[:, order]
+    means = np.cumsum(logs, axis=1)/np.arange(1, logs.shape[1] + 1)
+    return np.std(means[:, 1:-1] - means[:, 2:], axis=0, ddof=1)
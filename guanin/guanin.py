@@ -1,9 +1,13 @@
 import os
+import collections
 import tempfile
-import math
+import functools
+import importlib.util
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-import statistics
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from scipy.stats.mstats import gmean
@@ -15,14 +19,35 @@ import logging
 import argparse
 from fpdf import FPDF
 from sklearn.preprocessing import StandardScaler, quantile_transform
-from sklearn.neighbors import KNeighborsClassifier
-from mlxtend.feature_selection import SequentialFeatureSelector as SFS
 import seaborn as sns
 import time
 import pathlib
 import webbrowser
 from ERgene import FindERG
 
+from .rcc import RCCCache, listrccs, rccname, rccsources, readrcc
+from .cachefolder import usercachedir
+from .calibration import CalibrationModel
+from .context import AnalysisContext, asread
+from .exporter import ExportWriter
+from .featureselection import backwardselection, metricdict
+from .genes import GeneCatalogue
+from .grouptests import kruskal, ranksums
+from .genorm import elimination, logexpression, mvalues, pairwisevariation
+from .normmodel import NormalizationModel, altnegatives, refgenesweights
+from .qcmetrics import ENDOGENOUSCLASSES, HOUSEKEEPINGCLASSES, NEGATIVECLASSES, POSITIVECLASSES, backgrounds, lanemetrics, lowcounts, positivemetrics
+from .stagecache import ErrorFlag, StageCache, filedigest, snapshot, stagedigest, tabledigest
+from .store import copystore, isstore, readstore, writestore
+
+
+#count matrices written compressed with args.compression
+LARGETABLES = ['results/rnormcounts.csv', 'otherfiles/logarized_rnormcounts.csv', 'otherfiles/logarized_grouped_rnormcounts.csv',
+               'otherfiles/adnormcounts.csv', 'otherfiles/adnormcounts2.csv', 'otherfiles/rnormcounts2.csv', 'otherfiles/rngg.csv',
+               'otherfiles/rawcounts.csv', 'otherfiles/rawcounts2.csv', 'otherfiles/dfgenes.csv', 'otherfiles/rawfcounts.csv',
+               'otherfiles/tnormcounts.csv']
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+INFOLANESCOLUMNS = ['ID', 'Comments', 'FOV value', 'Binding Density', 'Background', 'Background2', 'Background3', 'Genes below backg %', 'nGenes', 'posGEOMEAN', 'Sum', 'Median', 'R2', 'limit of detection', '0,5fm']
 
 def getfolderpath(folder):
     '''RCC path'''
@@ -30,207 +55,190 @@ def getfolderpath(folder):
     path = cwd / folder
     return path
 
-def loadrccs(args, start_time = 0):
-    """ RCC loading to extract information"""
-    columns = ['ID', 'Comments', 'FOV value', 'Binding Density', 'Background', 'Background2', 'Background3', 'Genes below backg %', 'nGenes', 'posGEOMEAN', 'Sum', 'Median', 'R2', 'limit of detection', '0,5fm']
-    infolanes = pd.DataFrame(columns = columns)
+def classrows(codeclass, *codeclasses):
+    '''Row positions of codeclasses in a lane CodeClass array, in codeclasses order'''
+    return np.concatenate([np.flatnonzero(codeclass == i) for i in codeclasses])
 
-    dfgenes = pd.DataFrame() #counts
+def getgenes(args, counts):
+    '''GeneCatalogue for count table counts, the one built at load time (args.genes) if counts keeps its genes'''
+    if args.genes is not None:
+        return args.genes.forcounts(counts)
+    return GeneCatalogue.fromcounts(counts)
+
+def getrcccache(args):
+    '''Parsed RCC cache set by args.rcccache and args.rcccachesize (MB), None if disabled'''
+    if not args.rcccache or not args.rcccachesize:
+        return None
+    return RCCCache(args.rcccache, maxsize=args.rcccachesize*2**20)
+
+def loadlane(source, cache=None):
+    '''
+    Parses one RCC, a path or archive member from rccsources (through cache, a RCCCache, if given),
+    keeping its lane info and Code_Summary arrays. Counts of 0 are set to 1.
+    Module level so it can run in worker processes when loading RCCs in parallel.
+    '''
+    rcc = readrcc(source, cache)
+
+    lane = {}
+    lane['ID'] = rcc.id
+    lane['Comments'] = rcc.comments
+    lane['FOV value'] = rcc.fovvalue
+    lane['Binding Density'] = rcc.bindingdensity
+    lane['codeclass'] = rcc.codeclass
+    lane['names'] = rcc.names
+    lane['accessions'] = rcc.accessions
+    lane['counts'] = np.where(rcc.counts == 0, 1, rcc.counts)
+
+    return lane
+
+def generows(lane):
+    '''Rows of a lane kept as genes: endogenous, housekeeping, negatives and positives sorted by count'''
+    codeclass = lane['codeclass']
+    posrows = classrows(codeclass, *POSITIVECLASSES)
+    sortedposrows = posrows[np.argsort(-lane['counts'][posrows], kind='stable')]
+    return np.concatenate([classrows(codeclass, *ENDOGENOUSCLASSES), classrows(codeclass, *HOUSEKEEPINGCLASSES),
+                           classrows(codeclass, *NEGATIVECLASSES), sortedposrows])
+
+def getlanemetrics(lanes, args):
+    '''
+    QC metrics of loadlane results (see qcmetrics.lanemetrics), indexed by lane position.
+    Lanes with the same probes in the same order are computed together as one lanes x probes array.
+    '''
+    layouts = {}
+    for j, lane in enumerate(lanes):
+        layouts.setdefault((tuple(lane['codeclass']), tuple(lane['names'])), []).append(j)
+
+    metrics = [lanemetrics(np.vstack([lanes[j]['counts'] for j in js]), lanes[js[0]]['codeclass'], lanes=js,
+                           background=args.background, manualbackground=args.manualbackground)
+               for js in layouts.values()]
+    return pd.concat(metrics).sort_index()
+
+def maplanes(folder, files, args):
+    '''
+    Runs loadlane over the RCCs in files (from listrccs), in a process pool if args.jobs asks for more than one
+    process. RCCs are read as they are parsed, only a few per process wait in the pool. Keeps files order
+    '''
+    cache = getrcccache(args)
+    work = functools.partial(loadlane, cache=cache)
+    jobs = args.jobs
+    if jobs is None or jobs <= 0:
+        jobs = os.cpu_count()
+    lanes = {}
+    if jobs == 1 or len(files) <= 1:
+        for file, source in rccsources(folder, files):
+            lanes[file] = work(source)
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(files))) as pool:
+            pending = collections.deque()
+            for file, source in rccsources(folder, files):
+                pending.append((file, pool.submit(work, source)))
+                if len(pending) >= 4*jobs:
+                    file, lane = pending.popleft()
+                    lanes[file] = lane.result()
+            for file, lane in pending:
+                lanes[file] = lane.result()
+
+    if cache is not None:
+        cache.evict()
+    return [lanes[i] for i in files]
+
+def mergelanes(files, lanes, args, ngen=None, a=0):
+    '''
+    Builds infolanes rows and the counts, negatives, housekeeping and posneg tables from loadlane results.
+    Per-lane vectors are collected by lane ID and every table is built once at the end.
+
+    :param ngen: genes in the first lane of the analysis, taken from the first of lanes if None
+    :param a: lanes already loaded, when extending a previous load
+    '''
+    metrics = getlanemetrics(lanes, args)
+    ids = []
+    genes = {} #lane positions
+    negs = {}
+    hkes = {}
     dfposneg = {} #posnegs
 
-    geomeans = []
-    logconc = [7, 5, 3, 1, -1]
-
-    dfnegcount = pd.DataFrame()
-    negnames = []
-    dfhkecount = pd.DataFrame()
-    hkenames = []
-
-    a = 0 #loop count
-    for file in os.listdir(getfolderpath(args.folder)):
-        '''First data inspection'''
-        if '.RCC' in file:
-            df = pd.read_csv((getfolderpath(args.folder) / file), names=['CodeClass', 'Name', 'Accession', 'Count']) #count info dataframe
-            df = df.dropna()
-            df = df.replace('0','1')
-
-            #separate dataframe for gene class
-            dfpos = df[df.CodeClass =='Positive']
-            dfpos1 = df[df.CodeClass =='Positive1']
-            dfpos2 = df[df.CodeClass =='Positive2']
-            dfpos = pd.concat([dfpos, dfpos1, dfpos2])
-            dfneg = df[df.CodeClass =='Negative']
-            dfposneg1 = pd.concat([dfpos,dfneg])
-            dfend = df[df.CodeClass == 'Endogenous']
-            dfend1 = df[df.CodeClass == 'Endogenous1']
-            dfend2 = df[df.CodeClass == 'Endogenous2']
-            dfend = pd.concat([dfend, dfend1,dfend2])
-            dfhke = df[df.CodeClass =='Housekeeping']
-
-            convert_dict = {'CodeClass': str, 'Name': str, 'Accession': str, 'Count': float}
-            dfpos = dfpos.astype(convert_dict)
-            dfpos = dfpos.sort_values(by = ['Count'], ascending=False)
-            dfneg = dfneg.astype(convert_dict)
-            dfend = dfend.astype(convert_dict)
-            dfhke = dfhke.astype(convert_dict)
-            dff = pd.concat([dfend, dfhke, dfneg, dfpos])
-
-            names = ['parametro', 'valor']
-            dinf = pd.read_csv(getfolderpath(args.folder) / file, names=names, nrows=30, on_bad_lines='skip') #dataframe with lane info
-            dinf = dinf.dropna()
-            thislane = [] #info for this lane
-
-            #adds id from sample or from file name
-            id1 = dinf.loc[dinf['parametro'] == 'ID']
-            id1 = id1.loc[:,'valor']
-            id1 = id1.iloc[0]
-            id1 = str(id1)
-
-            if args.modeid == 'filename':
-                id1 = str(file)
-            elif args.modeid == 'id+filename':
-                id1 += str(file)
-
-            args.current_state = str('Loading RCC... ' + id1)
-            logging.info(args.current_state)
-
-            if args.autorename == 'on':
-                id1 = 'Renamed'
-                id1 = str(a) + id1
-                id1 = id1.strip()
-
-            comments = dinf.loc[dinf['parametro'] == 'Comments']
-            comments =comments.loc[:,'valor']
-            if len(comments) >= 1:
-                comments = comments.iloc[0]
-                comments = str(comments)
-            elif len(comments) < 1:
-                comments = 'no comments'
-
-            thislane.append(id1)
-            thislane.append(comments)
-
-            fovcount = dinf[dinf.parametro == 'FovCount']
-            fovcount = fovcount.valor
-            fovcounted = dinf[dinf.parametro == 'FovCounted']
-            fovcounted = fovcounted.valor
-            fovvalue = float(fovcounted)/float(fovcount)
-
-            thislane.append(fovvalue)
-
-            bd = dinf.loc[dinf['parametro'] == 'BindingDensity']
-            bd = bd.loc[:,'valor']
-            bd = float(bd)
-            thislane.append(bd)
-
-            topneg = 3*(np.mean(dfneg['Count']))
-
-            dfnegin = dfneg[dfneg.Count <= topneg]
-
-            background = (np.mean(dfnegin.Count)) + 2*(np.std(dfnegin.Count))
-            thislane.append(background)
-
-            background2 = np.max(dfnegin['Count'])
-            thislane.append(background2)
-
-            background3 = np.mean(dfnegin['Count'])
-            thislane.append(background3)
-
-            negs = list(dfneg['Count'])
-            negnames = dfneg['Name']
-            negnames = list(negnames)
-
-            maxout = 3*background3
-            rownegs = []
-            for i in negs:
-                rownegs.append(i)
-            rownegs.append(maxout)
-            dfnegcount[id1] = rownegs
-
-            hkes = list(dfhke['Count'])
-            hkenames = dfhke['Name']
-            hkenames = list(hkenames)
-            rowhkes = []
-            for i in hkes:
-                rowhkes.append(i)
-            dfhkecount[id1] = rowhkes
-
-            dfin = dff[dff.Count >= background]
-            dfout = dff[dff.Count < background]
-            gbb = len(dfout)
-            if a == 0:
-                ngen = gbb + len(dfin)
-
-            thislane.append(gbb*100/ngen)
-            thislane.append(ngen)
-
-            if a == 0:
-                dfgenes['CodeClass'] = dff['CodeClass']
-                dfgenes['Name'] = dff['Name']
-                dfgenes['Accession'] = dff['Accession']
-
-            dff.set_index('Name', inplace=True)
-
-            diff = None
-            if a != 0:
-                if set(dff.index) != set(dfgenes.index):
-                    diff = list(set(dff.index) - set(dfgenes.index))
-                if diff != None:
-                    diff.append(list(set(dfgenes.index) - set(dff.index)))
-                common = list(set(list(dff.index)).intersection(list(dfgenes.index)))
-                dff = dff.loc[common]
-                dfgenes = dfgenes.loc[common]
-                if diff != None:
-                    logging.warning('Mismatch, genes not present in all samples: ' + str(diff))
-
-            dfgenes.index = dff.index
-            dfgenes[id1] = dff['Count']
-            dfposneg[id1] = dfposneg1
-
-            posgeomean = gmean(dfpos.Count)
-            suma = dfpos.Count.sum()
-            median = statistics.median(dfpos.Count)
-            thislane.append(posgeomean)
-            thislane.append(suma)
-            thislane.append(median)
-            geomeans.append(posgeomean)
-
-            thislogsconc =[] #R2 calculation
-            thiscountnolow = []
-
-            #excluding lowest negative control
-            y = 0
-            while y < 5:
-                thiscountnolow.append(dfpos['Count'].iloc[y])
-                y = y+1
-
-            #log2 counts
-            for i in thiscountnolow:
-                thislog = math.log(i,2)
-                thislogsconc.append(thislog)
-
-            #r2 score calculaion
-            R2 = np.corrcoef(thislogsconc,logconc)
-            R2 = R2[1,0]
-
-            thislane.append(R2)
-
-            if args.manualbackground != None:
-                background = args.manualbackground
-            elif args.background == 'Background2':
-                background = background2
-            elif args.background == 'Background3':
-                background = background3
-
-            lod = background >= dfpos.iloc[4].Count
-            thislane.append(lod)
-
-            cerocincofm = dfpos.iloc[4].Count
-            thislane.append(cerocincofm)
-
-            infolanes.loc[a] = thislane
-            a = a+1
+    for j, (file, lane) in enumerate(zip(files, lanes)):
+        #adds id from sample or from file name
+        id1 = lane['ID']
+
+        if args.modeid == 'filename':
+            id1 = rccname(file)
+        elif args.modeid == 'id+filename':
+            id1 += rccname(file)
+
+        args.current_state = str('Loading RCC... ' + id1)
+        logging.info(args.current_state)
+
+        if args.autorename == 'on':
+            id1 = 'Renamed'
+            id1 = str(a) + id1
+            id1 = id1.strip()
+
+        codeclass = lane['codeclass']
+        negrows = classrows(codeclass, *NEGATIVECLASSES)
+        posnegrows = np.concatenate([classrows(codeclass, *POSITIVECLASSES), negrows])
+
+        ids.append(id1)
+        negs[id1] = list(lane['counts'][negrows]) + [3*metrics['Background3'].iloc[j]]
+        hkes[id1] = list(lane['counts'][classrows(codeclass, *HOUSEKEEPINGCLASSES)])
+        genes[id1] = j
+        dfposneg[id1] = pd.DataFrame({'CodeClass': codeclass[posnegrows], 'Name': lane['names'][posnegrows],
+                                      'Accession': lane['accessions'][posnegrows],
+                                      'Count': lane['counts'][posnegrows]}, index=posnegrows)
+        a = a+1
+
+    #genes below background %, against the genes of the first lane of the analysis
+    if ngen is None:
+        ngen = metrics['nGenes'].iloc[0]
+    infolanes = pd.DataFrame({'ID': ids})
+    for i in INFOLANESCOLUMNS[1:4]:
+        infolanes[i] = [lane[i] for lane in lanes]
+    for i in INFOLANESCOLUMNS[4:7] + INFOLANESCOLUMNS[9:]:
+        infolanes[i] = metrics[i].values
+    infolanes.insert(7, 'Genes below backg %', metrics['gbb'].values*100/ngen)
+    infolanes.insert(8, 'nGenes', ngen)
+
+    #genes present in every lane, in the order of the first lane
+    rows = [generows(lane) for lane in lanes]
+    lanenames = [pd.Index(lane['names'][i], name='Name') for lane, i in zip(lanes, rows)]
+    first = lanenames[0]
+    presence = pd.Series(np.concatenate([lanenames[j].unique().values for j in genes.values()])).value_counts()
+    common = first[(presence.reindex(first) == len(genes)).values].unique()
+    if len(presence) != len(common):
+        diff = sorted(set(presence.index) - set(common))
+        logging.warning('Mismatch, genes not present in all samples: ' + str(diff))
+
+    counts = np.empty((len(common), len(genes)))
+    for k, j in enumerate(genes.values()):
+        unique = ~lanenames[j].duplicated()
+        counts[:, k] = lanes[j]['counts'][rows[j]][unique][lanenames[j][unique].get_indexer(common)]
+
+    unique = ~first.duplicated()
+    firstrows = rows[0][unique][first[unique].get_indexer(common)]
+    dfgenes = pd.DataFrame({'CodeClass': lanes[0]['codeclass'][firstrows],
+                            'Accession': lanes[0]['accessions'][firstrows]}, index=common)
+    dfgenes = pd.concat([dfgenes, pd.DataFrame(counts, index=common, columns=list(genes.keys()))], axis=1)
+
+    lastlane = lanes[-1]
+    negnames = list(lastlane['names'][classrows(lastlane['codeclass'], *NEGATIVECLASSES)]) + ['maxoutlier']
+    hkenames = list(lastlane['names'][classrows(lastlane['codeclass'], *HOUSEKEEPINGCLASSES)])
+    dfnegcount = pd.DataFrame(list(negs.values()), index=list(negs.keys()), columns=negnames)
+    dfhkecount = pd.DataFrame(list(hkes.values()), index=list(hkes.keys()), columns=hkenames)
+
+    return infolanes, dfgenes, dfnegcount, dfhkecount, dfposneg
 
+def loadsettings(args):
+    '''Settings that change lane IDs or lane metrics, a previous load is only extended if they match'''
+    return {
+        'folder': str(getfolderpath(args.folder)),
+        'modeid': args.modeid,
+        'autorename': args.autorename,
+        'background': args.background,
+        'manualbackground': args.manualbackground,
+    }
+
+def finishinfolanes(infolanes, args):
+    '''Checks duplicated IDs and adds the cohort-level params to infolanes'''
     ##CHECK FOR DUPLICATED IDS
     if all(infolanes.duplicated(subset=['ID']) == False):
         args.current_state = str('--> All ' +  str(len(infolanes['ID'])) + ' IDs are unique, proceeding with analysis. Elapsed %s seconds ' % (time.time() - args.start_time))
@@ -243,7 +251,6 @@ def loadrccs(args, start_time = 0):
 
     '''Adding calculated params to infolanes'''
     meangeomeans = np.mean(infolanes['posGEOMEAN'])
-    scalingf = []
 
     if args.manualbackground != None:
         manualbglist = []
@@ -251,20 +258,97 @@ def loadrccs(args, start_time = 0):
             manualbglist.append(args.manualbackground)
         infolanes['manual background'] = manualbglist
 
-    for i in infolanes['posGEOMEAN']:
-        scaling = meangeomeans/i
-        scalingf.append(scaling)
-    infolanes['scaling factor'] = scalingf
+    infolanes['scaling factor'] = meangeomeans/infolanes['posGEOMEAN']
+
+    infolanes.set_index('ID', inplace=True)
+
+    return infolanes
 
-    dfnegcount = dfnegcount.T
-    negnames.append('maxoutlier')
-    dfnegcount.columns = negnames
+def loadrccs(args, start_time = 0, files=None):
+    """ RCC loading to extract information. files (from listrccs) restricts loading to some of the RCCs in folder"""
+    folder = getfolderpath(args.folder)
+    if files is None:
+        files = listrccs(folder)
+    lanes = maplanes(folder, files, args)
 
-    dfhkecount = dfhkecount.T
-    dfhkecount.columns = hkenames
+    infolanes, dfgenes, dfnegcount, dfhkecount, dfposneg = mergelanes(list(files), lanes, args)
+    infolanes = finishinfolanes(infolanes, args)
 
-    infolanes.set_index('ID', inplace=True)
-    dfgenes.drop('Name', axis=1, inplace=True)
+    args.loadedrccs = dict(loadsettings(args), files={i: j + [k] for (i, j), k in zip(files.items(), infolanes.index)})
+    args.genes = GeneCatalogue.fromcounts(dfgenes)
+
+    return infolanes, dfgenes, dfnegcount, dfhkecount, dfposneg
+
+def loadnewrccs(args, files=None):
+    '''
+    Incremental loadrccs: parses only the RCCs not loaded yet into args.outputfolder and appends them to the
+    raw tables of the previous load, recomputing just the cohort-level params. The raw tables are still exported
+    whole, scaling factors of every lane change with the cohort and counts tables have a column per lane.
+    Falls back to a full loadrccs, with a warning, when the previous load can't be extended: its intermediate
+    tables are missing (not in args.context nor on disk), settings changed or loaded RCCs changed.
+    files (from listrccs) restricts loading to some of the RCCs in folder.
+    '''
+    pathloaded = str(args.outputfolder) + '/otherfiles/loadedrccs.json'
+    folder = getfolderpath(args.folder)
+    if files is None:
+        files = listrccs(folder)
+
+    try:
+        with open(pathloaded) as f:
+            loaded = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.info('No previous RCC load to extend, loading all RCCs: ' + str(e))
+        return loadrccs(args, files=files)
+    try:
+        infolanes = readtable(args, 'info/rawinfolanes.csv', index_col='ID', float_precision='round_trip')
+        dfgenes = importcounts(args, 'rawcounts', float_precision='round_trip')
+        dfnegcount = readtable(args, 'otherfiles/dfnegcount.csv', index_col=0, float_precision='round_trip')
+        dfhkecount = readtable(args, 'otherfiles/dfhkecount.csv', index_col=0, float_precision='round_trip')
+        posnegcounts = readtable(args, 'otherfiles/posnegcounts.csv', index_col=0, float_precision='round_trip')
+    except (OSError, ValueError) as e:
+        logging.warning('Incremental load needs the intermediate tables of the previous load, written with '
+                        '--exportintermediates yes, loading all RCCs instead: ' + str(e))
+        return loadrccs(args, files=files)
+
+    loadedfiles = loaded.pop('files')
+    if loaded != loadsettings(args):
+        logging.warning('Loading settings changed since the previous load, loading all RCCs instead of the new ones')
+        return loadrccs(args, files=files)
+    if any(files.get(i) != j[:2] for i, j in loadedfiles.items()):
+        logging.warning('Previously loaded RCCs changed or were removed, loading all RCCs instead of the new ones')
+        return loadrccs(args, files=files)
+
+    newfiles = [i for i in files if i not in loadedfiles]
+    args.current_state = str('--> ' + str(len(newfiles)) + ' new RCCs to add to ' + str(len(loadedfiles)) + ' loaded lanes')
+    logging.info(args.current_state)
+    print(args.current_state)
+
+    dfposneg = {}
+    for i in posnegcounts.columns.drop('CodeClass'):
+        dfposneg[i] = pd.DataFrame({'Name': posnegcounts.index, 'CodeClass': posnegcounts['CodeClass'].values,
+                                    'Count': posnegcounts[i].values})
+
+    infolanes = infolanes.drop(columns=['scaling factor', 'manual background'], errors='ignore').reset_index()
+    if newfiles:
+        lanes = maplanes(folder, {i: files[i] for i in newfiles}, args)
+        newinfolanes, newgenes, newnegcount, newhkecount, newposneg = mergelanes(
+            newfiles, lanes, args, ngen=infolanes['nGenes'].iloc[0], a=len(infolanes))
+
+        infolanes = pd.concat([infolanes, newinfolanes], ignore_index=True)
+        common = dfgenes.index.intersection(newgenes.index)
+        if len(common) != len(dfgenes.index) or len(common) != len(newgenes.index):
+            diff = sorted(set(dfgenes.index).symmetric_difference(newgenes.index))
+            logging.warning('Mismatch, genes not present in all samples: ' + str(diff))
+        dfgenes = pd.concat([dfgenes.loc[common], newgenes.loc[common].drop(columns=['CodeClass', 'Accession'])], axis=1)
+        dfnegcount = pd.concat([dfnegcount, newnegcount])
+        dfhkecount = pd.concat([dfhkecount, newhkecount])
+        dfposneg.update(newposneg)
+
+    infolanes = finishinfolanes(infolanes, args)
+
+    loadedfiles.update({i: files[i] + [k] for i, k in zip(newfiles, infolanes.index[len(loadedfiles):])})
+    args.loadedrccs = dict(loadsettings(args), files=loadedfiles)
+    args.genes = GeneCatalogue.fromcounts(dfgenes)
 
     return infolanes, dfgenes, dfnegcount, dfhkecount, dfposneg
 
@@ -282,53 +366,145 @@ def createoutputfolder(args):
     pathoutotherfiles = str(args.outputfolder) + '/otherfiles'
     pathlib.Path(pathoutotherfiles).mkdir(parents=True, exist_ok=True)
 
+def isintermediate(path):
+    return path.startswith('otherfiles/')
+
+def getexporter(args):
+    '''Background writer of output files (args.exporter), None if args.exportqueue is 0 and files are written in place'''
+    if not args.exportqueue:
+        return None
+    if args.exporter is None:
+        args.exporter = ExportWriter(args.exportqueue)
+    return args.exporter
+
+def flushexports(args):
+    '''Waits until queued output files are written, before reading them back or opening them'''
+    if args.exporter is not None:
+        args.exporter.flush()
+
+def exportfile(args, path, write, digest=None, copy=shutil.copyfile):
+    '''write(path) through the background writer if enabled, see ExportWriter.submit'''
+    exporter = getexporter(args)
+    if exporter is None:
+        write(path)
+    else:
+        exporter.submit(path, write, digest=digest, copy=copy)
+
+def exporthtml(styler, args, path):
+    '''Renders a Styler to outputfolder/path'''
+    exportfile(args, str(args.outputfolder) + '/' + path, styler.to_html)
+
+def getcompression(args):
+    '''Compression of LARGETABLES, args.compression. zstd needs zstandard, gzip is used instead if it is missing'''
+    if args.compression == 'zstd' and importlib.util.find_spec('zstandard') is None:
+        logging.warning('zstandard is not installed (pip install guanin[zstd]), writing gzip compressed tables instead')
+        args.compression = 'gzip'
+    return args.compression
+
+def tablefile(args, path):
+    '''File of the csv table at outputfolder/path, plain or compressed, the args.compression one if there are both'''
+    pathtable = str(args.outputfolder) + '/' + path
+    for i in [COMPRESSIONS.get(args.compression, '')] + [''] + list(COMPRESSIONS.values()):
+        if os.path.isfile(pathtable + i):
+            return pathtable + i
+    return pathtable
+
+def writetable(table, args, path, **kwargs):
+    '''
+    Writes table to outputfolder/path with to_csv(**kwargs) and keeps it in args.context for later stages.
+    Intermediate tables (otherfiles) only go to disk if args.exportintermediates == 'yes', as csv or, with
+    args.intermediateformat == 'binary', to the binary store (path without .csv + .npy/.json).
+    Files are written and hashed by the background writer, which skips tables already written with the same content
+    '''
+    pathtable = str(args.outputfolder) + '/' + path
+    kept = None
+    if args.context is not None:
+        if kwargs.get('header', True) is not False:
+            kept = args.context.put(pathtable, table, index=kwargs.get('index', True))
+        if isintermediate(path) and args.exportintermediates == 'no':
+            return
+    digest = None
+    if args.exportqueue:
+        #hashed by the background writer, on a copy the stage can't change meanwhile (the context one if it keeps it)
+        table = kept if kept is not None else table.copy()
+        options = repr(sorted(kwargs.items()))
+        digest = lambda suffix='': tabledigest(table) + options + suffix
+    if isintermediate(path) and args.intermediateformat == 'binary':
+        index = kwargs.get('index', True)
+        exportfile(args, pathtable[:-len('.csv')] + '.npy', lambda x: writestore(table, x[:-len('.npy')], index=index),
+                   digest=digest and functools.partial(digest, 'binary'), copy=lambda x, y: copystore(x[:-len('.npy')], y[:-len('.npy')]))
+        return
+    if path in LARGETABLES and getcompression(args) != 'no':
+        #chunked to_csv through the compressed stream, the whole csv text is never in memory
+        kwargs['compression'] = {'method': args.compression, 'mtime': 0} if args.compression == 'gzip' else args.compression
+        kwargs.setdefault('chunksize', 10000)
+        pathtable += COMPRESSIONS[args.compression]
+        digest = digest and functools.partial(digest, args.compression)
+    exportfile(args, pathtable, lambda x: table.to_csv(x, **kwargs), digest=digest)
+
+def readtable(args, path, **kwargs):
+    '''
+    Table at outputfolder/path, from args.context if a stage wrote it, else from the binary store or with
+    read_csv(**kwargs). Binary stores are memory-mapped and keep their dtypes
+    '''
+    pathtable = str(args.outputfolder) + '/' + path
+    index_col = kwargs.get('index_col')
+    if args.context is not None and pathtable in args.context:
+        return args.context.get(pathtable, index_col=index_col)
+    flushexports(args)
+    if isintermediate(path) and args.intermediateformat == 'binary' and isstore(pathtable[:-len('.csv')]):
+        table, index = readstore(pathtable[:-len('.csv')])
+        if index and index_col is not None and (index_col == 0 or index_col == table.index.name):
+            table.columns = [str(i) for i in table.columns]
+            return table
+        return asread(table, index=index, index_col=index_col)
+    return pd.read_csv(tablefile(args, path), **kwargs)
+
+def exportcounts(counts, args, name):
+    '''Exports a count matrix to otherfiles/name, see writetable'''
+    writetable(counts, args, 'otherfiles/' + name + '.csv', index=True)
+
+def importcounts(args, name, index_col='Name', **kwargs):
+    '''Reads a count matrix exported by exportcounts, see readtable. kwargs go to read_csv'''
+    return readtable(args, 'otherfiles/' + name + '.csv', index_col=index_col, **kwargs)
+
 def exportrawcounts(rawcounts, args):
-    pathout = str(args.outputfolder) + '/otherfiles'
     rawcounts2 = rawcounts
-    pathraw = pathout + '/rawcounts.csv'
-    rawcounts2.to_csv(pathraw, index=True)
-    pathdfraw = pathout + '/dfgenes.csv'
-    rawcounts2.to_csv(pathdfraw, index=True)
+    exportcounts(rawcounts2, args, 'rawcounts')
+    exportcounts(rawcounts2, args, 'dfgenes')
 
     rawcounts3 = rawcounts2.drop(['CodeClass', 'Accession'], axis=1)
-    pathraw3 = pathout + '/rawcounts2.csv'
-    rawcounts3.to_csv(pathraw3, index=True)
+    exportcounts(rawcounts3, args, 'rawcounts2')
 
 def exportdfgenes(dfgenes, args):
-    pathout = str(args.outputfolder) + '/otherfiles'
-    pathdfgenes = pathout + '/dfgenes.csv'
-    dfgenes.to_csv(pathdfgenes, index=True)
+    exportcounts(dfgenes, args, 'dfgenes')
 
 def exportrawinfolanes(infolanes, dfnegcount, dfhkecount, dfposneg, args):
     '''
     Exports raw infolanes and dfnegcount, dfhkecount, dfposneg
     '''
-    pathout = str(args.outputfolder) + '/otherfiles'
-    pathout2 = str(args.outputfolder) + '/info'
-    pathinfolanes = pathout2 + '/rawinfolanes.csv'
-    pathdfnegcount = pathout + '/dfnegcount.csv'
-    pathdfhkecount = pathout + '/dfhkecount.csv'
-
     exportposneg(dfposneg, args)
 
-    infolanes.to_csv(pathinfolanes)
-    dfnegcount.to_csv(pathdfnegcount)
-    dfhkecount.to_csv(pathdfhkecount)
+    writetable(infolanes, args, 'info/rawinfolanes.csv')
+    writetable(dfnegcount, args, 'otherfiles/dfnegcount.csv')
+    writetable(dfhkecount, args, 'otherfiles/dfhkecount.csv')
+
+    exportloadedrccs(args)
+
+def exportloadedrccs(args):
+    '''Exports which RCC files are in the raw tables, so a later load can just add new ones (see loadnewrccs)'''
+    pathloaded = str(args.outputfolder) + '/otherfiles/loadedrccs.json'
+    with open(pathloaded, 'w') as f:
+        json.dump(args.loadedrccs, f, indent=1)
 
 def pathoutinfolanes(infolanes, args):
-    pathout = str(args.outputfolder) + '/info'
-    pathinfolanes = pathout + '/infolanes.csv'
-    infolanes.to_csv(pathinfolanes, index=True)
+    writetable(infolanes, args, 'info/infolanes.csv', index=True)
 
 def pathoutrawsummary(rawsummary, args):
-    pathout = str(args.outputfolder) + '/info'
-    pathrawsummary = pathout + '/rawsummary.csv'
-    rawsummary.to_csv(pathrawsummary, index=True)
+    writetable(rawsummary, args, 'info/rawsummary.csv', index=True)
 
 def pathoutsummary (summary, args):
-    pathout = str(args.outputfolder) + '/info'
-    pathsummary = pathout + '/summary.csv'
-    summary.to_csv(pathsummary, index=True)
+    writetable(summary, args, 'info/summary.csv', index=True)
 
 def condformat_summary(val, top, bot, colorbien = '#a3c771', colorreg = '#f0e986', colormal = '#e3689b'):
     if top >= val >= bot:
@@ -342,7 +518,7 @@ def condformat_summary(val, top, bot, colorbien = '#a3c771', colorreg = '#f0e986
 
 def summarizerawinfolanes(args):
 
-    rawinfolanes = pd.read_csv(str(args.outputfolder) + '/info/rawinfolanes.csv', index_col='ID')
+    rawinfolanes = readtable(args, 'info/rawinfolanes.csv', index_col='ID')
 
     rawinfofov = [np.min(rawinfolanes['FOV value']), np.max(rawinfolanes['FOV value']), np.mean(rawinfolanes['FOV value']), np.median(rawinfolanes['FOV value'])]
     rawinfobd = [np.min(rawinfolanes['Binding Density']), np.max(rawinfolanes['Binding Density']), np.mean(rawinfolanes['Binding Density']), np.median(rawinfolanes['Binding Density'])]
@@ -374,17 +550,18 @@ def summarizerawinfolanes(args):
     rawsummary = rawsummary.applymap(condformat_summary, top= args.maxscalingfactor, bot=args.minscalingfactor,  subset='Scaling factor')
 
 
-    rawsummary.to_html(str(args.outputfolder) + '/info/rawsummary.html')
+    exporthtml(rawsummary, args, 'info/rawsummary.html')
 
 
     if args.showbrowserrawqc == True:
+        flushexports(args)
         webbrowser.open(str(args.outputfolder) + '/info/rawsummary.html')
 
 
 
 
 def summarizeinfolanes(args):
-    infolanes = pd.read_csv(str(args.outputfolder) + '/info/infolanes.csv', index_col='ID')
+    infolanes = readtable(args, 'info/infolanes.csv', index_col='ID')
     infofov = [np.min(infolanes['FOV value']), np.max(infolanes['FOV value']), np.mean(infolanes['FOV value']), np.median(infolanes['FOV value'])]
     infobd = [np.min(infolanes['Binding Density']), np.max(infolanes['Binding Density']), np.mean(infolanes['Binding Density']), np.median(infolanes['Binding Density'])]
     infolin = [np.min(infolanes['R2']), np.max(infolanes['R2']), np.mean(infolanes['R2']), np.median(infolanes['R2'])]
@@ -416,25 +593,19 @@ def summarizeinfolanes(args):
                                      subset='Scaling factor')
 
     pathoutsummary(summary, args)
-    summary2view.to_html(str(args.outputfolder) + '/info/Summary.html')
+    exporthtml(summary2view, args, 'info/Summary.html')
 
     if args.showbrowserqc == True:
+        flushexports(args)
         webbrowser.open(str(args.outputfolder) + '/info/Summary.html')
 
 def exportposneg(dfposneg, args):
-    posnegcounts = pd.DataFrame()
+    posnegcounts = pd.concat({i: j.set_index('Name')['Count'] for i, j in dfposneg.items()}, axis=1)
+    lastlane = list(dfposneg.values())[-1].set_index('Name')
+    posnegcounts.insert(0, 'CodeClass', lastlane['CodeClass'])
+    posnegcounts.index.name = 'Name'
 
-    for i in dfposneg.keys():
-        a = dfposneg[i]
-        posnegcounts['Name'] = a['Name']
-        posnegcounts['CodeClass'] = a['CodeClass']
-        posnegcounts[i] = a['Count']
-
-    posnegcounts.set_index('Name', drop=True, inplace=True)
-
-    pathout = str(args.outputfolder)
-    pathposneg = pathout + '/otherfiles/posnegcounts.csv'
-    posnegcounts.to_csv(pathposneg, index=True)
+    writetable(posnegcounts, args, 'otherfiles/posnegcounts.csv', index=True)
 
 
 def plotfovvalue(args, infolanes):
@@ -659,7 +830,7 @@ def pdfreportnorm(args):
         os.system(str(args.outputfolder) + '/reports/QC_inspection.pdf')
 
 def flagqc(args):
-    infolanes = pd.read_csv(str(args.outputfolder) + '/info/rawinfolanes.csv', index_col='ID')
+    infolanes = readtable(args, 'info/rawinfolanes.csv', index_col='ID')
 
     flagged = set([])
     if os.path.exists(str(args.outputfolder) + '/info/QCflags.txt'):
@@ -731,8 +902,8 @@ def flagqc(args):
                 f.writelines(gbbinfo)
                 flagged.add(i)
     f.close()
-    flaggeddf = pd.DataFrame(flagged, columns=['Flagged_samples'])
-    flaggeddf.to_csv(str(args.outputfolder) + '/info/flagged.csv', index=False)
+    flaggeddf = pd.DataFrame(sorted(flagged), columns=['Flagged_samples'])
+    writetable(flaggeddf, args, 'info/flagged.csv', index=False)
 
     if len(flagged) >= 3:
         args.badlanes = str(len(flagged)) + ' badlanes detected, check output/info/QCflags.txt'
@@ -744,8 +915,8 @@ def flagqc(args):
     return flagged
 
 def removelanes(autoremove, args):
-    infolanes = pd.read_csv(str(args.outputfolder) + '/info/rawinfolanes.csv', index_col='ID')
-    dfgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/dfgenes.csv', index_col='Name')
+    infolanes = readtable(args, 'info/rawinfolanes.csv', index_col='ID')
+    dfgenes = importcounts(args, 'dfgenes')
     manualremove = args.remove
     if autoremove == None:
         autoremove = set(manualremove)
@@ -767,35 +938,25 @@ def removelanes(autoremove, args):
         print('Error: ' + args.curent_state)
         logging.error(args.current_state)
 
-    pathout = str(args.outputfolder)
-    pathinfolanes = pathout + '/info/infolanes.csv'
-    infolanes.to_csv(pathinfolanes, index=True)
+    writetable(infolanes, args, 'info/infolanes.csv', index=True)
     # exportdfgenes(dfgenes, args)
 
     return dfgenes11, infolanes
 
 def exportfilrawcounts(rawfcounts, args):
-    pathout = str(args.outputfolder)
-    rawfcounts2 = rawfcounts
-    pathfraw = pathout + '/otherfiles/rawfcounts.csv'
-    rawfcounts2.to_csv(pathfraw, index=True)
+    exportcounts(rawfcounts, args, 'rawfcounts')
 
 def rescalingfactor23(args):
     """Scaling factor needs to be recalculated after removing samples excluded by QC inspection"""
-    infolanes = pd.read_csv(str(args.outputfolder) + '/info/infolanes.csv', index_col=0)
+    infolanes = readtable(args, 'info/infolanes.csv', index_col=0)
 
     if args.tecnormeth == 'posgeomean' or args.tecnormeth == 'regression':
         use = 'posGEOMEAN'
         if args.tecnormeth == 'regression':
-            negs = pd.read_csv(str(args.outputfolder) + '/otherfiles/dfnegcount.csv', index_col=0)
+            negs = readtable(args, 'otherfiles/dfnegcount.csv', index_col=0)
             negs = negs.drop('maxoutlier', axis=1)
             corrected_negs = regretnegs(negs, args)
-            backgr_regr = []
-            for i in corrected_negs.index:
-                thisbackg_regr = (np.mean(corrected_negs.loc[i])) + 2*(np.std(corrected_negs.loc[i]))
-                backgr_regr.append(thisbackg_regr)
-
-            infolanes['backgr_regr'] = backgr_regr
+            infolanes['backgr_regr'] = backgrounds(corrected_negs, trim=False)[0]
 
     elif args.tecnormeth == 'Sum':
         use = 'Sum'
@@ -803,14 +964,7 @@ def rescalingfactor23(args):
         use = 'Median'
     ref = np.mean(infolanes[use])
 
-
-    scalingf2 = []
-
-    for i in infolanes[use]:
-        scaling = ref/i
-        scalingf2.append(scaling)
-
-    infolanes['scaling factor2'] = scalingf2
+    infolanes['scaling factor2'] = ref/infolanes[use]
 
     return infolanes
 
@@ -822,8 +976,8 @@ def reinfolanes(args):
     '''
 
     infolanes = findaltnegatives(args)
-    fildfgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/dfgenes.csv', index_col='Name')
-    rawdfgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/rawfcounts.csv', index_col='Name')
+    fildfgenes = importcounts(args, 'dfgenes')
+    rawdfgenes = importcounts(args, 'rawfcounts')
 
     if args.firsttransformlowcounts:
         dfgenes = rawdfgenes
@@ -831,15 +985,14 @@ def reinfolanes(args):
         dfgenes = fildfgenes
 
 
-    dfneg = dfgenes[dfgenes['CodeClass'] == 'Negative'].drop(['CodeClass', 'Accession'], axis=1).T
-    infolanes['Background'] = dfneg.mean(axis=1)+(2*(dfneg.std(axis=1)))
-    infolanes['Background2'] = dfneg.max(axis=1)
-    infolanes['Background3'] = dfneg.mean(axis=1)
+    dfneg = dfgenes.iloc[getgenes(args, dfgenes).rows('Negative')].drop(['CodeClass', 'Accession'], axis=1).T
+    for i, j in zip(['Background', 'Background2', 'Background3'], backgrounds(dfneg, trim=False, ddof=1)):
+        infolanes[i] = pd.Series(j, index=dfneg.index)
 
-    dfpos = fildfgenes[fildfgenes['CodeClass'] == 'Positive'].drop(['CodeClass', 'Accession'], axis=1).T
-    infolanes['posGEOMEAN'] = gmean(dfpos, axis=1)
-    infolanes['Sum'] = dfpos.sum(axis=1)
-    infolanes['Median'] = np.median(dfpos, axis=1)
+    dfpos = fildfgenes.iloc[getgenes(args, fildfgenes).rows('Positive')].drop(['CodeClass', 'Accession'], axis=1).T
+    posmetrics = positivemetrics(dfpos)
+    for i in ['posGEOMEAN', 'Sum', 'Median']:
+        infolanes[i] = pd.Series(posmetrics[i], index=dfpos.index)
 
     dfgenes4mean = dfgenes.drop(['CodeClass', 'Accession'], axis = 1).T
     infolanes['meanexpr'] = gmean(dfgenes4mean, axis=1)
@@ -853,49 +1006,29 @@ def reinfolanes(args):
     exportdfgenes(dfgenes, args)
 
 
-def regretnegs(negs, args):
-    corrected_negs = pd.DataFrame()
-    posneg = pd.read_csv(str(args.outputfolder) + '/otherfiles/posnegcounts.csv', index_col=0)
-    for i in posneg.index:
-        if 'NEG' in i:
-            posneg = posneg.drop(i, axis=0)
-
-    posneg2 = posneg.copy()
-    posneg2 = posneg2.drop('CodeClass', axis=1)
-    gmeans = []
-    for i in posneg2.index:
-        thisgmean = gmean(posneg2.loc[i])
-        gmeans.append(thisgmean)
-
-    posneg['mean'] = gmeans
-    xmean = sorted(posneg['mean'])
-    ymean = [31, 125, 500, 2000, 8000, 32000]
-
-    meaneq_abc = np.polynomial.Polynomial.fit(xmean, ymean, 3)
-
-    infolanes = pd.read_csv(str(args.outputfolder) + '/info/infolanes.csv')
-    for i in infolanes['ID']:
-        thisx = sorted(posneg[i])
-        thiseq_abc = np.polynomial.Polynomial.fit(thisx, ymean, 3)
-
-        def correct(thisseq_abc, meaneq_abc, counts):
-            this = thisseq_abc(counts)
-            solutions = (meaneq_abc - this).roots()
-            corrected = abs(min(solutions, key=lambda x: abs(x - counts)))
-            return corrected
-
-        thissample = []
-
-        newnegs = negs.T
-
-        corrected_negs.index = newnegs.index
-
-        for k in newnegs[str(i)]:
-            corrected = correct(thisseq_abc=thiseq_abc, meaneq_abc=meaneq_abc, counts=k)
+def getcalibration(args):
+    '''
+    CalibrationModel of the positive controls in otherfiles/posnegcounts.csv, fit once and kept in args.calibration.
+    With args.calibrationreference, the model of an earlier analysis, counts are corrected to its reference curve
+    '''
+    posneg = readtable(args, 'otherfiles/posnegcounts.csv', index_col=0)
+    source = tabledigest(posneg) + str(args.calibrationreference)
+    if args.calibration is None or args.calibration.source != source:
+        reference = None
+        if args.calibrationreference:
+            reference = CalibrationModel.load(args.calibrationreference)
+        args.calibration = CalibrationModel.fit(posneg, reference=reference, source=source)
+        args.calibration.save(str(args.outputfolder) + '/otherfiles/calibration.json')
+    return args.calibration
 
-            thissample.append(corrected)
+def regretnegs(negs, args):
+    calibration = getcalibration(args)
+    newnegs = negs.T
+    corrected_negs = pd.DataFrame(index=newnegs.index)
 
-        corrected_negs[str(i)] = thissample
+    infolanes = readtable(args, 'info/infolanes.csv')
+    for i in infolanes['ID']:
+        corrected_negs[str(i)] = calibration.correct(str(i), newnegs[str(i)])
 
     return corrected_negs.T
 
@@ -904,29 +1037,12 @@ def findaltnegatives(args):
     in case native neg controls are not robust
     Generates new infolanes with background alt in it'''
 
-    infolanes = pd.read_csv(str(args.outputfolder) + '/info/infolanes.csv', index_col=0)
-    dfgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/rawfcounts.csv', index_col='Name')
+    infolanes = readtable(args, 'info/infolanes.csv', index_col=0)
+    dfgenes = importcounts(args, 'rawfcounts')
     dfgenes.drop(['CodeClass', 'Accession'], inplace=True, axis=1)
     dfgenes = dfgenes.T
 
-    genmean = dfgenes.mean()
-    meangenmean = np.mean(genmean)
-    genmean = genmean/meangenmean
-
-    genmean.sort_values(inplace=True)
-
-    genstd = dfgenes.std()
-    meangenstd = np.mean(genstd)
-    genstd = genstd/meangenmean
-    genstd = genstd*2
-
-    genstd.sort_values(inplace=True)
-
-    genrank = genmean * genstd
-    genrank.sort_values(inplace=True)
-
-    bestaltnegs = genrank.head(10)
-    bestaltnegsnames = bestaltnegs.index
+    bestaltnegsnames = altnegatives(dfgenes)
 
     dfaltnegs = dfgenes[bestaltnegsnames]
 
@@ -940,28 +1056,15 @@ def findaltnegatives(args):
     return infolanes
 
 def normtecnica(dfgenes, args):
+    '''Counts of each lane times its scaling factor2, all lanes in one multiply'''
+    infolanes = readtable(args, 'info/infolanes.csv')
+    lanes = [str(i) for i in infolanes['ID']]
+    factors = infolanes['scaling factor2'].to_numpy(dtype=float)
 
-    infolanes = pd.read_csv(str(args.outputfolder) + '/info/infolanes.csv')
-
-    normgenes = pd.DataFrame()
-    normgenes['CodeClass'] = dfgenes['CodeClass']
-    normgenes['Name'] = dfgenes['Name']
-    normgenes['Accession'] = dfgenes['Accession']
-
-    for i in infolanes['ID']:
-        j = float(infolanes.loc[infolanes['ID'] == str(i), 'scaling factor2'])
-
-        this = []
-
-        for k in dfgenes[str(i)]:
-            m = j*k
-            this.append(m)
-
-        normgenes[str(i)] = this
-
-    normgenes.set_index('Name', drop=True, inplace=True)
+    normgenes = dfgenes[['CodeClass', 'Name', 'Accession']].set_index('Name')
+    normcounts = pd.DataFrame(dfgenes[lanes].to_numpy(dtype=float)*factors, index=normgenes.index, columns=lanes)
 
-    return normgenes
+    return pd.concat([normgenes, normcounts], axis=1)
 
 def regresion(dfgenes, args):
     normgenes = pd.DataFrame()
@@ -969,115 +1072,49 @@ def regresion(dfgenes, args):
     normgenes['Name'] = dfgenes['Name']
     normgenes['Accession'] = dfgenes['Accession']
 
-    posneg = pd.read_csv(str(args.outputfolder) + '/otherfiles/posnegcounts.csv', index_col=0)
-    for i in posneg.index:
-        if 'NEG' in i:
-            posneg = posneg.drop(i, axis=0)
-
-    posneg2 = posneg.copy()
-    posneg2 = posneg2.drop('CodeClass', axis=1)
-    gmeans = []
-    for i in posneg2.index:
-
-        thisgmean = gmean(posneg2.loc[i])
-        gmeans.append(thisgmean)
-
-    posneg['mean'] = gmeans
-
-    xmean = sorted(posneg['mean'])
-    ymean = [31, 125, 500, 2000, 8000, 32000]
+    calibration = getcalibration(args)
 
-    meaneq_abc = np.polynomial.Polynomial.fit(xmean, ymean, 3)
-
-    infolanes = pd.read_csv(str(args.outputfolder) + '/info/infolanes.csv')
+    infolanes = readtable(args, 'info/infolanes.csv')
     for i in infolanes['ID']:
-        thisx = sorted(posneg[i])
-        thiseq_abc = np.polynomial.Polynomial.fit(thisx, ymean, 3)
-
-        def correct(thisseq_abc, meaneq_abc, counts):
-            this = thisseq_abc(counts)
-            solutions = (meaneq_abc - this).roots()
-            corrected = abs(min(solutions, key=lambda x: abs(x - counts)))
-            return corrected
-
-        thissample = []
-
-        for k in dfgenes[str(i)]:
-            corrected = correct(thisseq_abc=thiseq_abc, meaneq_abc=meaneq_abc, counts=k)
-
-            thissample.append(corrected)
-
-        normgenes[str(i)] = thissample
+        normgenes[str(i)] = calibration.correct(str(i), dfgenes[str(i)])
 
     normgenes.set_index('Name', drop=True, inplace=True)
     return normgenes
 
 
 def transformlowcounts(args):
-
-    dfgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/dfgenes.csv', index_col='Name')
-    infolanes = pd.read_csv(str(args.outputfolder) + '/info/infolanes.csv')
-
-    ilanes = infolanes.T
-
-    ilanes.columns = ilanes.iloc[0]
-    ilanes = ilanes.drop(['ID'])
-    varback = args.lowcounts
-    varbg = args.background
+    '''Counts below the background of each lane (or the manual background) are treated as args.lowcounts says, see lowcounts'''
+    dfgenes = importcounts(args, 'dfgenes')
+    infolanes = readtable(args, 'info/infolanes.csv')
 
     # if args.tecnormeth == 'regression':
     #     varbg = 'backgr_regr'
 
-    if args.manualbackground != None:
-        mvarbg = args.manualbackground
-
-        if varback == 'skip':
-            pass
-
-        elif varback == 'asim':
-            for i in infolanes['ID']:
-                estebg = mvarbg
-                dfgenes.loc[dfgenes[i] <= estebg, i] = estebg
-        elif varback == 'sustract':
-            for i in infolanes['ID']:
-                estebg = mvarbg
-                dfgenes.loc[dfgenes[i] <= estebg, i] = 0
-                dfgenes.loc[dfgenes[i] > estebg, i] = dfgenes[i] - estebg
-                dfgenes.replace(0,1,inplace=True)
-
-    else:
-        if varback == 'skip':
-            pass
-        elif varback == 'asim':
-            for i in infolanes['ID']:
-                estebg = ilanes.at[varbg,i]
-                dfgenes.loc[dfgenes[i] <= estebg, i] = estebg
-        elif varback == 'sustract':
-            for i in infolanes['ID']:
-                estebg = ilanes.at[varbg,i]
-                dfgenes.loc[dfgenes[i] <= estebg, i] = 0
-                dfgenes.loc[dfgenes[i] > estebg, i] = dfgenes[i] - estebg
-                dfgenes.replace(0,1,inplace=True)
+    if args.lowcounts != 'skip':
+        lanes = list(infolanes['ID'])
+        if args.manualbackground != None:
+            background = args.manualbackground
+        else:
+            background = infolanes[args.background].to_numpy(dtype=float)
+        dfgenes[lanes] = lowcounts(dfgenes[lanes].to_numpy(dtype=float).T, background, args.lowcounts).T
 
     exportdfgenes(dfgenes, args)
 
     return dfgenes
 
 def exporttnormgenes(normgenes, args):
-    pathout = str(args.outputfolder)
-    pathnormgenes = pathout + '/otherfiles/tnormcounts.csv'
-    normgenes.to_csv(pathnormgenes, index=True)
+    exportcounts(normgenes, args, 'tnormcounts')
 
 def getallhkes(args):
-    dfgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/dfgenes.csv', index_col='Name')
+    dfgenes = importcounts(args, 'dfgenes')
 
-    allhkes = dfgenes.loc[dfgenes.loc[:,'CodeClass'] == 'Housekeeping']
+    allhkes = dfgenes.iloc[getgenes(args, dfgenes).kind('Housekeeping')]
 
     return allhkes
 
 def filter50chkes(allhkes, args):
     '''Filters housekeeping genes with less than 50 counts'''
-    infolanes = pd.read_csv(str(args.outputfolder) + '/info/infolanes.csv')
+    infolanes = readtable(args, 'info/infolanes.csv')
     selhkes = pd.DataFrame()
 
     for i in infolanes['ID']:
@@ -1092,11 +1129,10 @@ def filter50chkes(allhkes, args):
 def findrefend(args, selhkes):
     '''Finds endogenous that can be used as reference genes'''
 
-    dfgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/tnormcounts.csv')
+    dfgenes = importcounts(args, 'tnormcounts', index_col=None)
 
-    norm2end = dfgenes.loc[dfgenes['CodeClass'] == 'Endogenous']
-    norm2end1 = dfgenes.loc[dfgenes['CodeClass'] == 'Endogenous1']
-    norm2end = pd.concat([norm2end,norm2end1])
+    genes = getgenes(args, dfgenes)
+    norm2end = dfgenes.iloc[genes.rows('Endogenous', 'Endogenous1')]
     norm2end = norm2end.drop(['CodeClass','Accession'], axis='columns')
 
     norm2end2 = norm2end.set_index('Name')
@@ -1115,25 +1151,19 @@ def findrefend(args, selhkes):
     #     refgenes.drop('Accession', axis='columns', inplace=True)
 
     if args.refendgenes == 'endhkes':
-        for i in bestend:
-            isbest = norm2end.loc[:,'Name'] == i
-            refgen = norm2end.loc[isbest]
-            refgen.set_index('Name', drop=True, inplace=True)
-            refgenes = pd.concat([refgenes, refgen])
+        refgen = dfgenes.iloc[genes.ids(bestend)].drop(['CodeClass','Accession'], axis='columns')
+        refgenes = pd.concat([refgenes, refgen.set_index('Name')])
 
     return refgenes
 
 def pathoutrefgenes(refgenes, args):
-    pathout = str(args.outputfolder)
-    pathrefgenesview = pathout + '/otherfiles/refgenesview.csv'
-    refgenes.to_csv(pathrefgenesview, header=True, index=True)
+    writetable(refgenes, args, 'otherfiles/refgenesview.csv', header=True, index=True)
     refgenes = refgenes.T
-    pathrefgenes = pathout + '/otherfiles/refgenes.csv'
-    refgenes.to_csv(pathrefgenes, header=True, index=True)
+    writetable(refgenes, args, 'otherfiles/refgenes.csv', header=True, index=True)
 
 def getgroups(args):
-    refgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/refgenes.csv', index_col=0)
-    flagged = pd.read_csv(str(args.outputfolder) + '/info/flagged.csv')
+    refgenes = readtable(args, 'otherfiles/refgenes.csv', index_col=0)
+    flagged = readtable(args, 'info/flagged.csv')
     flagged = set(flagged['Flagged_samples'])
     dfgroups = pd.read_csv(args.groupsfile, header=0, index_col=0)
     if args.laneremover == 'yes':
@@ -1147,53 +1177,24 @@ def getgroups(args):
     for i in groups:
         a = list(dfgroups[dfgroups['GROUP'] == i].index)
         d[i] = a
-        newa = []
-        for j in a:
-            if j in refgenes.index:
-                newa.append(j)
-        ddf[i] = refgenes.loc[newa]
+        newa = refgenes.index.get_indexer_for(a)
+        ddf[i] = refgenes.iloc[newa[newa >= 0]]
 
     return ddf
 
 def calkruskal(*args):
     '''Kruskal wallis calculation
-    Takes dfa-like dataframes, groups with samples at y and ref genes at x'''
-    gencount = 0
-
-    lk = {}
-    for i in args[0]:
-        la = []
-        a = args[0].iloc[:,gencount]
-
-        gcount = 0
-        for j in args:
-            b = args[gcount].iloc[:,gencount]
-            la.append(b)
-            gcount+=1
-        try:
-            krus = stats.kruskal(*la)
-        except Exception:
-            pass
-        lk[a.name] = krus
-        gencount +=1
-
-    lk = pd.DataFrame.from_dict(lk)
-    lk = lk.rename(index={0:'Result', 1: 'pvalue'})
+    Takes dfa-like dataframes, groups with samples at y and ref genes at x. Genes where the test
+    can't be computed get NaN, see grouptests'''
+    h, pvalue = kruskal([i.to_numpy(dtype=float) for i in args])
+    lk = pd.DataFrame([h, pvalue], index=['Result', 'pvalue'], columns=args[0].columns)
 
     return lk
 
 def calwilco(dfa,dfb):
     '''Calculates wilcoxon for every pair of groups'''
-    count = 0
-    lw = {}
-    for i in dfa:
-        a = dfa.iloc[:,count]
-        b = dfb.iloc[:,count]
-        k = stats.ranksums(a,b)
-        lw[i] = k
-        count += 1
-    lw = pd.DataFrame.from_dict(lw)
-    lw = lw.rename(index={0:'Result', 1: 'pvalue'})
+    z, pvalue = ranksums(dfa.to_numpy(dtype=float), dfb.to_numpy(dtype=float))
+    lw = pd.DataFrame([z, pvalue], index=['Result', 'pvalue'], columns=dfa.columns)
     return lw
 
 def calwilcopairs(*ddfc):
@@ -1220,7 +1221,7 @@ def flagkrus(reskrus):
     return flaggedgenes
 
 def filterkruskal(flaggedgenes, args):
-    refgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/refgenes.csv', index_col=0)
+    refgenes = readtable(args, 'otherfiles/refgenes.csv', index_col=0)
     if args.filtergroupvariation == 'filterkrus':
         if (len(refgenes.columns) - len(flaggedgenes)) <=2:
             args.current_state = 'Too much genes to be removed from kruskal filtering, consider using another refgenes or change settings to "flagkrus".'
@@ -1232,9 +1233,7 @@ def filterkruskal(flaggedgenes, args):
         args.current_state = str('Genes not recommended as refgenes by kruskal: ' + str(flaggedgenes) + '.')
         logging.warning(args.current_state)
         print(args.current_state)
-    pathout = str(args.outputfolder)
-    pathrefgenes = pathout + '/otherfiles/refgenes.csv'
-    refgenes.to_csv(pathrefgenes, header=True, index=True)
+    writetable(refgenes, args, 'otherfiles/refgenes.csv', header=True, index=True)
     return refgenes
 
 def flagwilcox(reswilcopairs):
@@ -1247,7 +1246,7 @@ def flagwilcox(reswilcopairs):
     return flaggedwilcox
 
 def filterwilcox(flaggedwilcox, args):
-    refgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/refgenes.csv', index_col=0)
+    refgenes = readtable(args, 'otherfiles/refgenes.csv', index_col=0)
     if args.filtergroupvariation == 'filterwilcox':
         if len(flaggedwilcox) < len(refgenes.columns) and (len(refgenes.columns) - len(flaggedwilcox)) > 2:
             refgenes = refgenes.drop(columns=flaggedwilcox)
@@ -1259,105 +1258,46 @@ def filterwilcox(flaggedwilcox, args):
         args.current_state = 'Genes not recommended as refgenes by wilcoxon: ' + str(flaggedwilcox) + '.'
         print(args.current_state)
         logging.warning(args.current_state)
-    pathout = str(args.outputfolder)
-    pathrefgenes = pathout + '/otherfiles/refgenes.csv'
-    refgenes.to_csv(pathrefgenes, header=True, index=True)
+    writetable(refgenes, args, 'otherfiles/refgenes.csv', header=True, index=True)
     return refgenes
 
 def measureM(df, ctVal=False):
-    if ctVal == True:
-        for column in df:
-            minimo = min(df[column])
-            df[column] = df[column] - minimo
-        df = 2**-df
-    else:
-        for column in df:
-            maximo = max(df[column])
-            df[column] = df[column] / maximo
-    m=list(df.index)
-
-    n=list(df.columns)
+    '''geNorm M of each gene (column) of df, samples x genes, sorted from least to most stable, see genorm'''
+    M_a = pd.DataFrame({'Genes': list(df.columns), 'M': mvalues(logexpression(df, ctVal))}, index=df.columns)
+    M_a = M_a.sort_values('M', ascending=False)
 
-    M_a = pd.DataFrame()
-    for j in n:
-        Vjk= []
-        for k in n:
-            Ajk=[]
-            for i in m:
-                Ajk.append(np.log2(df.at[i,j]/df.at[i,k]))
-            Vjk.append(np.std(Ajk, ddof=1))
+    return M_a
 
-        M_a.at[j,'Genes'] = j
+def genormranking(df, ctVal=False):
+    '''
+    geNorm of df (samples x genes) in a single elimination pass, see genorm.elimination. Returns M of every gene
+    (as measureM), the ranking with the average M of each step (as geNorm) and the pairwise variations (as pairwiseV)
+    '''
+    genes = list(df.columns)
+    m, order, avgm = elimination(logexpression(df, ctVal))
 
-        M_a.at[j, 'M'] = np.sum(Vjk)/(len(n)-1)
+    M_a = pd.DataFrame({'Genes': genes, 'M': m}, index=df.columns)
     M_a = M_a.sort_values('M', ascending=False)
 
-    return M_a
+    #the most stable pair closes the ranking, both with its average M
+    genorm = pd.DataFrame([[genes[i], j] for i, j in zip(order, np.append(avgm, avgm[-1]))])
+    genorm.index = np.arange(start=1, stop=len(genorm)+1)
 
-def geNorm(df, avgm=pd.DataFrame()):
-    result = measureM(df)
-    n = len(df.columns)
-    if n <= 2:
-        bestgen = result.iat[0,0]
-        newrow = pd.DataFrame([[bestgen, result['M'].mean()]])
-        avgm = pd.concat([avgm, newrow])
-        lastrow = pd.DataFrame([[result.iat[1,0], result.iat[1,1]]])
-        avgm = pd.concat([avgm, lastrow])
-        newindex2 = np.arange(start=1, stop = len(avgm[0])+1)
-        avgm.index = newindex2
-        return avgm
-    else:
-        bestgen = result.iat[0,0]
-        newrow = pd.DataFrame([[bestgen, result['M'].mean()]])
-        avgm = pd.concat([avgm, newrow])
-        newdf = df.drop(bestgen,axis=1)
-        return geNorm(newdf, avgm)
-
-def pairwiseV(datarefgenes):
-    Vs = pd.DataFrame()
-
-    buf = geNorm(datarefgenes)
-    n = len(buf[0])
-    m = np.arange(start=0, stop=n-2)
-
-    a = 2
-    for i in m:
-        mas = np.arange(start=1, stop=a+1)
-        genes2 = []
-        genes3 = []
-        for z in mas:
-            gen = buf.iloc[n-z,0]
-            genes2.append(gen)
-            genes3.append(gen)
-        lmas = len(mas)+1
-        genes3.append(buf.iloc[n-lmas,0])
-
-        df2 = datarefgenes.loc[:,genes2]
-        df3 = datarefgenes.loc[:,genes3]
-
-        medias2 = []
-        medias3 = []
-        for j in df2.index:
-            media2 = gmean(df2.loc[j])
-            medias2.append(media2)
-            media3 = gmean(df3.loc[j])
-            medias3.append(media3)
-
-        logmedias = []
-        for k,l in zip(medias2,medias3):
-            n1 = k/l
-            An_n1 = np.log2(n1)
-            logmedias.append(An_n1)
-
-        Vn_n1 = np.std(logmedias, ddof=1)
-
-        newvn = pd.DataFrame([[f'V{a}/V{a+1}', Vn_n1]])
-        Vs = pd.concat([Vs, newvn])
-
-        newindex = np.arange(start=1, stop = len(Vs[0])+1)
-        Vs.index = newindex
+    return M_a, genorm, pairwiseV(df, genorm)
 
-        a = a+1
+def geNorm(df):
+    '''Genes of df in geNorm elimination order with the average M of each step, see genormranking'''
+    return genormranking(df)[1]
+
+def pairwiseV(datarefgenes, genorm=None):
+    '''Pairwise variations V(n/n+1) along the geNorm ranking genorm, computed if not given, see genorm.pairwisevariation'''
+    buf = geNorm(datarefgenes) if genorm is None else genorm
+
+    order = [datarefgenes.columns.get_loc(i) for i in buf[0][::-1]]
+    values = pairwisevariation(np.log2(datarefgenes.to_numpy(dtype=float)), order)
+
+    Vs = pd.DataFrame([[f'V{a}/V{a+1}', j] for a, j in enumerate(values, start=2)])
+    Vs.index = np.arange(start=1, stop=len(Vs)+1)
     return Vs
 
 def ploteme(eme, args):
@@ -1411,22 +1351,22 @@ def getnamesrefgenes(uvedf, genorm, args):
     return names
 
 def takerefgenes(names, args):
-    datarefgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/refgenes.csv')
+    datarefgenes = readtable(args, 'otherfiles/refgenes.csv')
     datarefgenes = datarefgenes.rename(columns={'Unnamed: 0': 'Name'})
     datarefgenes = datarefgenes.set_index('Name')
     bestrefgenes = datarefgenes[names]
-    bestrefgenes.to_csv(str(args.outputfolder) + '/otherfiles/bestrefgenes.csv', index=True)
+    writetable(bestrefgenes, args, 'otherfiles/bestrefgenes.csv', index=True)
 
     return bestrefgenes
 
 def rankfeaturegenes(data, targets, args, verbose=0):
     '''
-    'data' can be refgenes (usual, fast exploration) or all genes (very large analysis, several hours) using all genes to further visualization"
+    'data' can be refgenes (usual, fast exploration) or all genes (larger analysis, minutes, see featureselection and
+    args.featureselectiontime) using all genes to further visualization"
     'targets' must be single column sample-class association
     'num_neighbors' can simplify analysis, default 5, shouldnt be lower than 3
     '''
     num_neighbors_neighbors = args.featureselectionneighbors
-    knn = KNeighborsClassifier(n_neighbors=num_neighbors_neighbors)
     targets.set_index('SAMPLE', inplace=True)
 
     stargets = set(targets.index)
@@ -1446,15 +1386,10 @@ def rankfeaturegenes(data, targets, args, verbose=0):
     X = data
     y = targets
 
-    sfs1 = SFS(knn, k_features=1, forward=False, floating=False, verbose=0, scoring='balanced_accuracy', cv=2, n_jobs=-1)
-    sfs1 = sfs1.fit(X, y.values.ravel())
-    subsets = sfs1.subsets_
+    subsets = backwardselection(X.to_numpy(dtype=float), y.values.ravel(), int(num_neighbors_neighbors), cv=2,
+                                kfeatures=args.featureselectionk, timebudget=args.featureselectiontime, jobs=args.jobs)
 
-    subsets = pd.DataFrame.from_dict(subsets)
-
-    feature_names = subsets.iloc[3,:]
-
-    metrics = pd.DataFrame.from_dict(sfs1.get_metric_dict()).T
+    metrics = pd.DataFrame.from_dict(metricdict(subsets, list(X.columns))).T
     return metrics
 
 def rankstatsrefgenes(metrics, reskrus, reswilcopairs):
@@ -1471,14 +1406,14 @@ def rankstatsrefgenes(metrics, reskrus, reswilcopairs):
      return ranking
 
 def getallgenesdf(args):
-     df = pd.read_csv(str(args.outputfolder) + '/otherfiles/tnormcounts.csv')
+     df = importcounts(args, 'tnormcounts', index_col=None)
      df.drop(['CodeClass', 'Accession'], axis=1, inplace=True)
      df.set_index('Name', inplace=True)
      df = df.T
      return df
 
 def gettopngenesdf(args):
-    df = pd.read_csv(str(args.outputfolder) + '/otherfiles/tnormcounts.csv')
+    df = importcounts(args, 'tnormcounts', index_col=None)
     df.drop(['CodeClass', 'Accession'], axis=1, inplace=True)
     df.set_index('Name', inplace=True)
     df['mean'] = df.mean(axis=1)
@@ -1490,18 +1425,13 @@ def gettopngenesdf(args):
 
 def getnormfactor(refgenesdf, eme, args):
 
-    infolanes = pd.read_csv(str(args.outputfolder) + '/info/infolanes.csv')
+    infolanes = readtable(args, 'info/infolanes.csv')
     geomeans1 = {}
     refgenesdf.set_index(infolanes['ID'], inplace=True)
 
     if args.contnorm == 'ponderaterefgenes':
-        eme.set_index('Genes', drop=True, inplace=True)
-        eme2 = eme
-
-        eme2['M'] = eme2['M'] * len(eme['M']) / sum(eme['M'])
-
-        for i in refgenesdf.columns:
-            refgenesdf[i] = refgenesdf[i] * float(eme2.loc[i])
+        weights = refgenesweights(eme)
+        refgenesdf = refgenesdf * weights[refgenesdf.columns]
 
     for i in refgenesdf.index:
         igeomean = gmean(refgenesdf.loc[i])
@@ -1515,21 +1445,58 @@ def getnormfactor(refgenesdf, eme, args):
     return normfactor
 
 def refnorm(normfactor, args):
+    '''Technically normalized counts of each lane times its normfactor, a dict of lane: factor'''
+    df = importcounts(args, 'tnormcounts')
+    thisnormgenes = df.drop(['CodeClass', 'Accession'], axis=1)
+    factors = np.array([normfactor[i] for i in thisnormgenes.columns], dtype=float)
+    return thisnormgenes.astype(float)*factors
+
+def exportnormmodel(args, names, eme):
+    '''
+    Writes the NormalizationModel of this analysis to results/normalizationmodel.json, so new lanes can be
+    normalized against this cohort (see applynormmodel)
+    '''
+    if args.contnorm == 'all':
+        genes = getallgenesdf(args).columns
+    elif args.contnorm == 'topn':
+        genes = gettopngenesdf(args).columns
+    else:
+        genes = names
+    weights = refgenesweights(eme) if args.contnorm == 'ponderaterefgenes' else None
+    calibration = getcalibration(args) if args.tecnormeth == 'regression' else None
+
+    counts = importcounts(args, 'rawfcounts')
+    infolanes = readtable(args, 'info/rawinfolanes.csv', index_col='ID')
+    alt = altnegatives(counts.drop(['CodeClass', 'Accession'], axis=1).T)
+    model = NormalizationModel.fit(counts, infolanes, args, genes, weights=weights, altnegatives=alt, calibration=calibration)
+    model.save(str(args.outputfolder) + '/results/normalizationmodel.json')
+    return model
+
+def applynormmodel(args, flagged=()):
+    '''
+    Normalizes the lanes loaded in outputfolder against the model in args.normmodel, lane by lane and with
+    the model settings, instead of selecting refgenes again. Lanes flagged by QC are left out if args.laneremover
+    '''
+    model = NormalizationModel.load(args.normmodel)
+    counts = importcounts(args, 'rawcounts')
+    infolanes = readtable(args, 'info/rawinfolanes.csv', index_col='ID')
+
+    if args.laneremover == 'yes':
+        remove = set(flagged)
+        if args.remove != None:
+            remove.update(args.remove.split() if type(args.remove) == str else args.remove)
+        counts = counts.drop([i for i in counts.columns if i in remove], axis=1)
+
+    tnormgenes, rnormgenes, adnormgenes, rngg = model.apply(counts, infolanes)
 
-    df = pd.read_csv(str(args.outputfolder) + '/otherfiles/tnormcounts.csv')
-
-    rnormgenes = pd.DataFrame()
-    rnormgenes['Name'] = df.loc[:,'Name']
-    thisnormgenes = df.drop(['CodeClass','Name','Accession'], axis=1)
-    for i in thisnormgenes:
-        nfactor = normfactor[i]
-        thisnormed = []
-        for j in thisnormgenes[i]:
-            thiscell = nfactor*j
-            thisnormed.append(thiscell)
-        rnormgenes[i] = thisnormed
-    rnormgenes.set_index('Name', inplace=True)
-    return rnormgenes
+    exporttnormgenes(tnormgenes, args)
+    pathoutrnormgenes(rnormgenes, args)
+    if model.settings['adnormalization'] != 'no':
+        pathoutadnormgenes(adnormgenes, args)
+    if model.settings['logarizedoutput'] != 'no':
+        writetable(rngg, args, 'otherfiles/logarized_rnormcounts.csv')
+    writetable(rngg, args, 'otherfiles/rngg.csv', index=True)
+    return rngg
 
 def grouprnormgenes(args, *dfs):
     if args.groupsinrnormgenes == 'yes':
@@ -1548,20 +1515,14 @@ def grouprnormgenes(args, *dfs):
     return ddf2
 
 def pathoutrnormgenes(df, args):
-    pathout = str(args.outputfolder)
-    pathrnorm = pathout + '/results/rnormcounts.csv'
-    df.to_csv(pathrnorm)
-    path2rnorm = pathout + '/otherfiles/rnormcounts2.csv'
+    writetable(df, args, 'results/rnormcounts.csv')
     df2 = df
-    df2.to_csv(path2rnorm, index=False, header=False)
+    writetable(df2, args, 'otherfiles/rnormcounts2.csv', index=False, header=False)
 
 def pathoutadnormgenes(df, args):
-    pathout = str(args.outputfolder)
-    pathadnorm = pathout + '/otherfiles/adnormcounts.csv'
-    df.to_csv(pathadnorm)
-    path2adnorm = pathout + '/otherfiles/adnormcounts2.csv'
+    writetable(df, args, 'otherfiles/adnormcounts.csv')
     df2 = df
-    df2.to_csv(path2adnorm, index=False, header=False)
+    writetable(df2, args, 'otherfiles/adnormcounts2.csv', index=False, header=False)
 
 def adnormalization(df, args, rnormgenes):
 
@@ -1613,9 +1574,7 @@ def logarizeoutput(rnormgenes, args):
         if args.logarizedoutput == '10':
             logarizedgenes = rnormgenes2.applymap(lambda x: np.log10(x))
 
-        pathout = str(args.outputfolder)
-        pathlogarized = pathout + '/otherfiles/logarized_rnormcounts.csv'
-        logarizedgenes.to_csv(pathlogarized)
+        writetable(logarizedgenes, args, 'otherfiles/logarized_rnormcounts.csv')
         return logarizedgenes
 
 def logarizegroupedcounts(rnormgenesgroups, args):
@@ -1627,9 +1586,7 @@ def logarizegroupedcounts(rnormgenesgroups, args):
             rngg = rngg.applymap(lambda x: np.log10(x))
 
         rngg.loc['group'] = rnormgenesgroups.loc['group']
-        pathout = str(args.outputfolder)
-        pathlogarizedgrouped = pathout + '/otherfiles/logarized_grouped_rnormcounts.csv'
-        rngg.to_csv(pathlogarizedgrouped)
+        writetable(rngg, args, 'otherfiles/logarized_grouped_rnormcounts.csv')
 
         return rngg
 
@@ -1730,9 +1687,14 @@ def plotevalraw(matrix, what, meaniqrraw, args):
     return estoo
 
 
-def argParser():
+def argParser(argv=None):
     parser = argparse.ArgumentParser(description="Nanostring quality control analysis")
-    parser.add_argument('-f', '--folder', type=str, default= pathlib.Path.cwd() / '../examples/d1_COV_GSE183071', help='relative folder where RCC set is located. Default: /data')
+    parser.add_argument('-f', '--folder', type=str, default= pathlib.Path.cwd() / '../examples/d1_COV_GSE183071', help='relative folder, or .tar/.tar.gz/.zip archive, where RCC set is located. RCCs can be gzipped. Default: /data')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes to load RCCs and run feature selection with, 0 uses all cores')
+    parser.add_argument('-rc', '--rcccache', type=str, default=str(usercachedir('rcccache')), help='folder to cache parsed RCCs in between loads. Only used if no other user can write to it. Empty disables it')
+    parser.add_argument('-inc', '--incremental', type=str, default='no', choices=['yes', 'no'], help='only load RCCs not loaded yet in output folder and add them to the previous analysis. Needs the intermediate tables of that analysis (--exportintermediates yes, csv or binary), or all RCCs are loaded again')
+    parser.add_argument('-rcs', '--rcccachesize', type=int, default=256, help='max size of the parsed RCC cache in MB, 0 disables the cache')
+    parser.add_argument('-itf', '--intermediateformat', type=str, default='csv', choices=['csv', 'binary'], help='format of intermediate tables (otherfiles): csv or a typed, memory-mapped binary store (.npy + .json) that keeps dtypes and exact values')
     parser.add_argument('-minf', '--minfov', type=float, default=0.75, help='set manually min fov for QC')
     parser.add_argument('-maxf', '--maxfov', type=float, default=1, help='set manually max fov for QC')
     parser.add_argument('-minbd', '--minbd', type=float, default=0.1, help='set manually min binding density for QC')
@@ -1756,6 +1718,8 @@ def argParser():
     parser.add_argument('-crg', '--chooserefgenes', type=str, nargs='+', default = None, help = 'list of strings like. choose manualy reference genes to use over decided-by-program ones')
     parser.add_argument('-fgv', '--filtergroupvariation', type=str, default='filterkrus', choices=['filterkrus', 'filterwilcox', 'flagkrus', 'flagwilcox', 'nofilter'], help='¿filter or flag preselected ref genes by significative group-driven differences? needs groups to be declared')
     parser.add_argument('-fsn', '--featureselectionneighbors', type=float, default=4, help='number of neighbors for feature selection analysis of refgenes. recommended 3-6')
+    parser.add_argument('-fsk', '--featureselectionk', type=int, default=1, help='feature selection removes genes until this many are left')
+    parser.add_argument('-fst', '--featureselectiontime', type=float, default=None, help='seconds after which feature selection stops removing genes, metrics keep the subsets ranked so far')
     parser.add_argument('-g', '--groups', type=str, default='yes', choices=['yes','no'], help='defining groups for kruskal/wilcox/fs analysis?')
     parser.add_argument('-ne', '--numend', type=int, default=6, help='number of endogenous tofind by ERgene to include in analysis to check viability as refgenes')
     parser.add_argument('-ar', '--autorename', type=str, default='off', choices=['on', 'off'], help='turn on when sample IDs are not unique, be careful on sample identification detail')
@@ -1774,15 +1738,128 @@ def argParser():
     parser.add_argument('-ftl', '--firsttransformlowcounts', type=bool, default=True)
     parser.add_argument('-of', '--outputfolder', type=str, default=tempfile.gettempdir() + '/guanin_output')
     parser.add_argument('-sll', '--showlastlog', type=bool, default = False)
-    return parser.parse_args()
+    parser.add_argument('-cr', '--calibrationreference', type=str, default=None, help='otherfiles/calibration.json of an earlier analysis: regression corrects counts to its reference curve, so batches share it')
+    parser.add_argument('-nm', '--normmodel', type=str, default=None, help='results/normalizationmodel.json of an earlier analysis: apply mode (and watch mode) normalize lanes against it instead of selecting refgenes again')
+    parser.add_argument('-pi', '--pollinterval', type=float, default=5, help='watch mode: seconds between checks of the RCC folder')
+    parser.add_argument('-stt', '--settletime', type=float, default=10, help='watch mode: seconds a RCC must stay unchanged before loading it, so files still being written are skipped')
+    parser.add_argument('-ei', '--exportintermediates', type=str, default='yes', choices=['yes', 'no'], help='write intermediate tables (otherfiles) to disk, stages pass them in memory anyway. Incremental loads need them')
+    parser.add_argument('-cmp', '--compression', type=str, default='no', choices=['no', 'gzip', 'zstd'], help='write count matrices (results/rnormcounts, rawcounts, adnormcounts...) compressed. zstd needs the zstandard package')
+    parser.add_argument('-eq', '--exportqueue', type=int, default=8, help='max output files waiting for the background writer, 0 writes them in place')
+    parser.add_argument('-sc', '--stagecache', type=str, default=str(usercachedir('stagecache')), help='folder to keep stage results in, stages whose inputs and settings did not change reuse them. Only used if no other user can write to it. Empty disables it')
+    parser.add_argument('-scs', '--stagecachesize', type=int, default=1024, help='max size of the stage cache in MB, 0 disables the cache')
+    parser.set_defaults(genes=None, exporter=None, calibration=None)
+    args = parser.parse_args(argv)
+    newrun(args)
+    return args
+
+def newrun(args):
+    '''
+    Starts a new analysis on args, with an empty context and no stage digests, so no tables or stage results of an
+    earlier run are taken
+    '''
+    args.context = AnalysisContext()
+    args.stagedigests = {}
+
+def getstagecache(args):
+    '''Stage cache set by args.stagecache and args.stagecachesize (MB), None if disabled'''
+    if not args.stagecache or not args.stagecachesize:
+        return None
+    return StageCache(args.stagecache, maxsize=args.stagecachesize*2**20)
+
+def stage(name, settings, state=('current_state',), needs=(), inputs=None, cacheable=None):
+    '''
+    Runs the decorated stage through the stage cache. The stage key covers the args fields in settings, the
+    digests of the stages in needs (args.stagedigests) and inputs(args), digests of files read from outside the
+    output folder. On a hit, the outputs, context tables, args fields in state and result the stage got the
+    first time are restored instead of running it. Stages that fail, or log an error, are not stored.
+
+    :param cacheable: function of args, False when the stage can't be reused (e.g. incremental loads)
+    '''
+    def decorator(run):
+        @functools.wraps(run)
+        def cachedrun(args):
+            args.stagedigests.pop(name, None)
+            cache = getstagecache(args)
+            if cache is None or any(i not in args.stagedigests for i in needs) or (cacheable is not None and not cacheable(args)):
+                return run(args)
+            try:
+                extra = inputs(args) if inputs is not None else []
+            except OSError:
+                return run(args)
+            key = cache.key(name, {i: getattr(args, i) for i in settings}, [args.stagedigests[i] for i in needs] + extra)
+
+            folder = pathlib.Path(args.outputfolder)
+            flushexports(args)
+            stored = cache.get(key)
+            if stored is not None:
+                createoutputfolder(args)
+                for i, content in stored['files'].items():
+                    (folder / i).parent.mkdir(parents=True, exist_ok=True)
+                    (folder / i).write_bytes(content)
+                if args.context is not None:
+                    for i, (table, index) in stored['tables'].items():
+                        args.context.put(str(args.outputfolder) + '/' + i, table, index=index)
+                for i, value in stored['state'].items():
+                    setattr(args, i, value)
+                args.stagedigests[name] = stored['digest']
+                print('--> ' + name + ': inputs and settings unchanged, reusing stored results')
+                logging.info(name + ': reused stage cache entry ' + key)
+                return stored['result']
+
+            before = snapshot(folder)
+            tablesbefore = dict(args.context.tables) if args.context is not None else {}
+            errors = ErrorFlag()
+            logging.getLogger().addHandler(errors)
+            try:
+                result = run(args)
+                #the entry takes the stage outputs from disk
+                flushexports(args)
+            finally:
+                logging.getLogger().removeHandler(errors)
+            if errors.raised:
+                return result
+
+            after = snapshot(folder)
+            files = {i: (folder / i).read_bytes() for i, stat in after.items() if before.get(i) != stat}
+            prefix = str(args.outputfolder) + '/'
+            tables = {}
+            if args.context is not None:
+                tables = {i[len(prefix):]: table for i, table in args.context.tables.items()
+                          if i.startswith(prefix) and tablesbefore.get(i) is not table}
+            digest = stagedigest(files, tables)
+            cache.put(key, {'files': files, 'tables': tables, 'state': {i: getattr(args, i) for i in state if hasattr(args, i)},
+                            'result': result, 'digest': digest})
+            cache.evict()
+            args.stagedigests[name] = digest
+            return result
+        return cachedrun
+    return decorator
+
+QCSETTINGS = ['minfov', 'maxfov', 'minbd', 'maxbd', 'minlin', 'maxlin', 'minscalingfactor', 'maxscalingfactor', 'pbelowbackground']
+STORESETTINGS = ['intermediateformat', 'exportintermediates', 'compression']
+REFGENESSETTINGS = ['groupsfile', 'groups', 'refendgenes', 'numend', 'mincounthkes', 'filtergroupvariation',
+                    'featureselectionneighbors', 'featureselectionk', 'featureselectiontime', 'chooserefgenes', 'nrefgenes', 'laneremover', 'modeview'] + STORESETTINGS
+
+def rccfolderdigest(args):
+    '''Sizes and mtimes of the RCCs in args.folder, which is relative to the package as getfolderpath takes it'''
+    return [listrccs(getfolderpath(args.folder))]
+
+def groupsfiledigest(args):
+    return [filedigest(args.groupsfile) if os.path.isfile(args.groupsfile) else None]
+
+def calibrationdigest(args):
+    return [filedigest(args.calibrationreference) if args.calibrationreference else None]
 
 #################BIG BLOCKS -- BUTTONS
-def showinfolanes(args):
+def showinfolanes(args, files=None):
     '''
-    Load RCCS and show infolanes
+    Load RCCS and show infolanes. files (from listrccs) restricts loading to some of the RCCs in folder
     '''
 
-    infolanes, dfgenes, dfnegcount, dfhkecount, dfposneg = loadrccs(args)
+    if args.incremental == 'yes':
+        infolanes, dfgenes, dfnegcount, dfhkecount, dfposneg = loadnewrccs(args, files)
+    else:
+        infolanes, dfgenes, dfnegcount, dfhkecount, dfposneg = loadrccs(args, files=files)
 
     createoutputfolder(args)
 
@@ -1819,9 +1896,10 @@ def showinfolanes(args):
     infolanes = infolanes.applymap(condformat_infolanes, top= args.maxscalingfactor, bot=args.minscalingfactor,  subset='scaling factor')
 
 
-    infolanes.to_html(str(args.outputfolder) + '/info/rawinfolanes.html')
+    exporthtml(infolanes, args, 'info/rawinfolanes.html')
 
     if args.showbrowserrawqc == True:
+        flushexports(args)
         webbrowser.open(str(args.outputfolder) + '/info/rawinfolanes.html')
 
 def plotandreport(args, whatinfolanes = 'rawinfolanes'):
@@ -1832,12 +1910,12 @@ def plotandreport(args, whatinfolanes = 'rawinfolanes'):
     :return:
     '''
     if whatinfolanes == 'rawinfolanes':
-        infolanes = pd.read_csv(str(args.outputfolder) + '/info/rawinfolanes.csv', index_col='ID')
+        infolanes = readtable(args, 'info/rawinfolanes.csv', index_col='ID')
     elif whatinfolanes == 'infolanes':
-        infolanes = pd.read_csv(str(args.outputfolder) + '/info/infolanes.csv', index_col=0)
+        infolanes = readtable(args, 'info/infolanes.csv', index_col=0)
 
-    dfnegcount = pd.read_csv(str(args.outputfolder) + '/otherfiles/dfnegcount.csv', index_col=0)
-    dfhkecount = pd.read_csv(str(args.outputfolder) + '/otherfiles/dfhkecount.csv', index_col=0)
+    dfnegcount = readtable(args, 'otherfiles/dfnegcount.csv', index_col=0)
+    dfhkecount = readtable(args, 'otherfiles/dfhkecount.csv', index_col=0)
 
     if args.modeview != 'justrun':
         plotfovvalue(args, infolanes)
@@ -1856,6 +1934,9 @@ def plotandreport(args, whatinfolanes = 'rawinfolanes'):
     pdfreport(args)
 
 
+@stage('runQCview', ['folder', 'modeid', 'autorename', 'background', 'manualbackground', 'modeview'] + QCSETTINGS + STORESETTINGS,
+       state=('loadedrccs', 'genes', 'current_state'), inputs=rccfolderdigest,
+       cacheable=lambda args: args.incremental == 'no')
 def runQCview(args):
     try:
         showinfolanes(args)
@@ -1888,12 +1969,83 @@ def runQCview(args):
     if args.showbrowserrawqc == True:
         webbrowser.open(str(pathlib.Path.cwd()) + '/guanin_analysis_description.log')
 
+def watchfolder(args):
+    '''
+    Watch mode for RCCs written by the instrument. Polls folder every args.pollinterval seconds and, when RCCs
+    have stayed unchanged for args.settletime seconds, adds them to the analysis in outputfolder (incremental
+    load), refreshing rawinfolanes and rawsummary and flagging lanes with flagqc rules. With args.normmodel, loaded
+    lanes are also normalized against it (see applynormmodel). Runs until interrupted.
+    '''
+    args.incremental = 'yes'
+    folder = getfolderpath(args.folder)
+    seen = {} #file: [size, mtime], unchanged since
+    loaded = None
+    flagged = set()
+
+    args.current_state = '--> Watching ' + str(folder) + ' for new RCCs, stop with Ctrl+C'
+    logging.info(args.current_state)
+    print(args.current_state)
+
+    try:
+        while True:
+            now = time.time()
+            try:
+                files = listrccs(folder)
+            except OSError as e:
+                logging.warning('Unable to list RCC folder: ' + str(e))
+                files = {}
+
+            #RCCs already there and untouched at start don't wait settle time
+            for i, j in files.items():
+                if i not in seen or seen[i][0] != j:
+                    seen[i] = (j, min(now, j[1]/10**9))
+            settled = {i: j for i, j in files.items() if now - seen[i][1] >= args.settletime}
+
+            if settled and settled != loaded:
+                try:
+                    showinfolanes(args, settled)
+                    newflagged = set(flagqc(args))
+                    if args.normmodel:
+                        applynormmodel(args, newflagged)
+                except Exception as e:
+                    args.current_state = 'Something went wrong loading new RCCs, retrying on next check. Error: ' + str(e)
+                    logging.error(args.current_state)
+                    print(args.current_state)
+                else:
+                    loaded = settled
+                    args.current_state = str('--> ' + str(len(loaded)) + ' lanes loaded. ' + args.badlanes)
+                    if newflagged - flagged:
+                        args.current_state += '. Newly flagged: ' + ', '.join(sorted(newflagged - flagged))
+                    flagged = newflagged
+                    logging.info(args.current_state)
+                    print(args.current_state)
+
+            time.sleep(args.pollinterval)
+    except KeyboardInterrupt:
+        args.current_state = '--> Stopped watching ' + str(folder)
+        logging.info(args.current_state)
+        print(args.current_state)
+
+
+def runapply(args):
+    '''Loads RCCs, flags them and normalizes them against the normalization model in args.normmodel'''
+    try:
+        showinfolanes(args)
+        flagged = flagqc(args)
+        applynormmodel(args, flagged)
+        args.current_state = '--> Lanes normalized against ' + str(args.normmodel) + '. ' + args.badlanes
+        print(args.current_state)
+        logging.info(args.current_state)
+    except Exception as e:
+        args.current_state = 'Unable to normalize lanes against normalization model. Error: ' + str(e)
+        print(args.current_state)
+        logging.error(args.current_state)
 
 def runQCfilterpre(args):
     '''
     This func assumes you have run runQCview and selected some filtering and configuration parameters
     '''
-    dfgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/dfgenes.csv')
+    dfgenes = importcounts(args, 'dfgenes', index_col=None)
     flagged = flagqc(args)
 
     if args.laneremover == 'yes':
@@ -1936,15 +2088,18 @@ def runQCfilterpre(args):
     infolanes = infolanes.applymap(condformat_infolanes, top= args.pbelowbackground, bot=0,  subset='Genes below backg %')
     infolanes = infolanes.applymap(condformat_infolanes, top= args.maxscalingfactor, bot=args.minscalingfactor,  subset='scaling factor')
 
-    infolanes.to_html(str(args.outputfolder) + '/info/infolanes.html')
+    exporthtml(infolanes, args, 'info/infolanes.html')
 
     if args.showbrowserqc == True:
+        flushexports(args)
         webbrowser.open(str(args.outputfolder) + '/info/infolanes.html')
 
     summarizeinfolanes(args)
 
     return flagged
 
+@stage('runQCfilter', QCSETTINGS + ['laneremover', 'remove', 'tecnormeth', 'background', 'manualbackground', 'calibrationreference'] + STORESETTINGS,
+       state=('badlanes', 'current_state'), needs=('runQCview',), inputs=calibrationdigest)
 def runQCfilter(args):
     try:
         runQCfilterpre(args)
@@ -1956,19 +2111,19 @@ def runQCfilter(args):
     except Exception as e:
         args.current_state = 'Unknown error while QC filtering, check input data and parameters. Error: ' + str(e)
         print(args.current_state)
-        logging.info(args.current_state)
+        logging.error(args.current_state)
 
     if args.showbrowserqc == True:
         webbrowser.open(str(pathlib.Path.cwd()) + '/guanin_analysis_description.log')
 
-
+@stage('technorm', ['firsttransformlowcounts', 'tecnormeth', 'lowcounts', 'background', 'manualbackground', 'calibrationreference'] + STORESETTINGS,
+       needs=('runQCview', 'runQCfilter'), inputs=calibrationdigest)
 def technorm(args):
 
-
     if args.firsttransformlowcounts == True:
         transformlowcounts(args)
         reinfolanes(args)
-        dfgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/dfgenes.csv')
+        dfgenes = importcounts(args, 'dfgenes', index_col=None)
         if args.tecnormeth != 'regression':
             normgenes = normtecnica(dfgenes, args)
         elif args.tecnormeth == 'regression':
@@ -1976,7 +2131,7 @@ def technorm(args):
         print('uwu')
 
     elif args.firsttransformlowcounts == False:
-        dfgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/dfgenes.csv')
+        dfgenes = importcounts(args, 'dfgenes', index_col=None)
         if args.tecnormeth != 'regression':
             normgenes = normtecnica(dfgenes, args)
         elif args.tecnormeth == 'regression':
@@ -1998,14 +2153,16 @@ def technorm(args):
     #     logging.error(args.current_state)
 
 
-def contnorm(args):
-    logging.info('Starting content normalization')
-
+@stage('refgenes', REFGENESSETTINGS, state=('refgenessel', 'current_state'), needs=('runQCview', 'runQCfilter', 'technorm'),
+       inputs=groupsfiledigest)
+def selectrefgenes(args):
+    '''
+    Selects reference genes among housekeeping and best endogenous candidates (ERgene, kruskal/wilcoxon, geNorm
+    and feature selection). Returns selected names, their counts and geNorm M values
+    '''
     if os.path.isfile(args.groupsfile):
         targets = pd.read_csv(args.groupsfile)
         groups = set(targets['GROUP'])
-        if len(groups)>1:
-            args.groups = 'yes'
 
     allhkes = getallhkes(args)
     args.current_state = '--> Selecting refgenes. Elapsed %s seconds ' + str((time.time() - args.start_time))
@@ -2075,13 +2232,9 @@ def contnorm(args):
     print(
         '--> Applying genorm to select best ranking selection of refgenes from candidate refgenes. Elapsed %s seconds ' % (
                     time.time() - args.start_time))
-    datarefgenes = pd.read_csv(str(args.outputfolder) + '/otherfiles/refgenes.csv', index_col=0)
+    datarefgenes = readtable(args, 'otherfiles/refgenes.csv', index_col=0)
 
-    eme = measureM(datarefgenes)
-
-    genorm = geNorm(datarefgenes)
-
-    uve = pairwiseV(datarefgenes)
+    eme, genorm, uve = genormranking(datarefgenes)
 
     print('--> Performing geNorm calculations')
 
@@ -2116,7 +2269,7 @@ def contnorm(args):
 
     bestrefgenes = takerefgenes(names, args)
 
-    dataref = pd.read_csv(str(args.outputfolder) + '/otherfiles/refgenes.csv', index_col=0)
+    dataref = readtable(args, 'otherfiles/refgenes.csv', index_col=0)
 
 
     print('--> Performing feature selection for refgenes evaluation and control.')
@@ -2142,11 +2295,12 @@ def contnorm(args):
         for i in ranking2.columns:
             ranking2 = ranking2.applymap(condformat_ranking, top=1, bot=0.05, subset = i)
 
-        ranking2.to_html(str(args.outputfolder) + '/info/ranking_kruskal_wilcox.html')
+        exporthtml(ranking2, args, 'info/ranking_kruskal_wilcox.html')
         print('done')
-        ranking.to_csv(str(args.outputfolder) + '/info/ranking_kruskal_wilcox.csv')
+        writetable(ranking, args, 'info/ranking_kruskal_wilcox.csv')
 
     if args.showbrowsercnorm == True:
+            flushexports(args)
             webbrowser.open(str(args.outputfolder) + '/info/ranking_kruskal_wilcox.html')
 
     if args.groups == 'yes':
@@ -2162,12 +2316,28 @@ def contnorm(args):
 
         metrics2 = metrics.style.applymap(condformat_metrics, top=1.5/len(groups), bot=0.5/len(groups), subset='avg_score')
 
-        metrics2.to_html(str(args.outputfolder) + '/otherfiles/metrics_reverse_feature_selection.html')
-        metrics.to_csv(str(args.outputfolder) + '/reports/metrics_reverse_feature_selection.csv')
+        exporthtml(metrics2, args, 'otherfiles/metrics_reverse_feature_selection.html')
+        writetable(metrics, args, 'reports/metrics_reverse_feature_selection.csv')
 
     if (args.showbrowsercnorm == True) and (args.groups == 'yes'):
+        flushexports(args)
         webbrowser.open(str(args.outputfolder) + '/otherfiles/metrics_reverse_feature_selection.html')
 
+    return names, bestrefgenes, eme
+
+@stage('contnorm', REFGENESSETTINGS + ['contnorm', 'topngenestocontnorm', 'adnormalization', 'groupsinrnormgenes', 'logarizedoutput'],
+       state=('groups', 'refgenessel', 'current_state'), needs=('runQCview', 'runQCfilter', 'technorm'), inputs=groupsfiledigest)
+def contnorm(args):
+    logging.info('Starting content normalization')
+
+    if os.path.isfile(args.groupsfile):
+        targets = pd.read_csv(args.groupsfile)
+        groups = set(targets['GROUP'])
+        if len(groups)>1:
+            args.groups = 'yes'
+
+    names, bestrefgenes, eme = selectrefgenes(args)
+
 
     print('--> Getting lane-specific normfactor and applying content normalization. Elapsed %s seconds ' % (
                 time.time() - args.start_time))
@@ -2202,31 +2372,39 @@ def contnorm(args):
     else:
         rngg = logarizeoutput(adnormgenes, args)
 
-    rngg.to_csv(str(args.outputfolder) + '/otherfiles/rngg.csv', index=True)
+    writetable(rngg, args, 'otherfiles/rngg.csv', index=True)
+
+    try:
+        exportnormmodel(args, names, eme)
+    except Exception as e:
+        logging.warning('Unable to export normalization model: ' + str(e))
+
     return rngg, names
 
+@stage('evalnorm', ['logarizeforeval', 'logarizedoutput', 'groupsinrnormgenes'] + STORESETTINGS,
+       needs=('runQCview', 'runQCfilter', 'technorm', 'contnorm'))
 def evalnorm(args):
     args.current_state = '--> Evaluating and plotting normalization results. Elapsed %s seconds ' + str((time.time() - args.start_time))
     print(args.current_state)
     logging.info(args.current_state)
-    rngg = pd.read_csv(str(args.outputfolder) + '/otherfiles/rngg.csv', index_col = 'Name')
-    rawcounts = pd.read_csv(str(args.outputfolder) + '/otherfiles/rawcounts2.csv', index_col=0)
+    rngg = readtable(args, 'otherfiles/rngg.csv', index_col = 'Name')
+    rawcounts = importcounts(args, 'rawcounts2', index_col=0)
     rlegenes = RLEcal(rngg, args)
     rleraw = RLEcal(logarizeoutput(rawcounts, args), args)
 
     meaniqr = getmeaniqr(rlegenes)
     meaniqrraw = getmeaniqr(rleraw)
 
-    rawcounts = pd.read_csv(str(args.outputfolder) + '/otherfiles/rawcounts.csv', index_col='Name')
+    rawcounts = importcounts(args, 'rawcounts')
     rawcounts.drop(['CodeClass', 'Accession'], inplace=True, axis=1)
 
-    rawfcounts = pd.read_csv(str(args.outputfolder) + '/otherfiles/rawfcounts.csv', index_col='Name')
+    rawfcounts = importcounts(args, 'rawfcounts')
     rawfcounts.drop(['CodeClass', 'Accession'], inplace=True, axis=1)
 
-    tnormcounts = pd.read_csv(str(args.outputfolder) + '/otherfiles/tnormcounts.csv', index_col='Name')
+    tnormcounts = importcounts(args, 'tnormcounts')
     tnormcounts.drop(['CodeClass', 'Accession'], inplace=True, axis=1)
 
-    rnormcounts = pd.read_csv(str(args.outputfolder) + '/results/rnormcounts.csv', index_col='Name')
+    rnormcounts = readtable(args, 'results/rnormcounts.csv', index_col='Name')
 
     print('Plotting raw RLE plot...')
     plotevalraw(rawcounts, 'RAW counts', meaniqrraw, args)
@@ -611,6 +611,7 @@ class CentralWidget(QWidget):
         self.parent.statusBar().repaint()
         logging.debug(f"state.groupsfile = {self.state.groupsfile}")
         logging.debug(f"state.folder = {self.state.folder}")
+        guanin.newrun(self.state)
         guanin.runQCview(self.state)
         self.parent.statusBar().showMessage(self.state.current_state)
 
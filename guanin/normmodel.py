@@ -0,0 +1,207 @@
+'''
+Frozen normalization of a reference analysis, to normalize new lanes against it.
+
+A NormalizationModel keeps what technical and content normalization took from the reference cohort: the mean
+positive control metric (or the calibration curve for regression), the reference genes with their weights and
+their mean geometric mean, the background choice and the additional normalization scaler. Applied to new lanes,
+every lane is normalized on its own against those values, without selecting reference genes again.
+'''
+import json
+
+import numpy as np
+import pandas as pd
+from scipy.stats.mstats import gmean
+from sklearn.preprocessing import quantile_transform
+
+from .calibration import CalibrationModel
+from .qcmetrics import lowcounts, positivemetrics
+
+
+#analysis settings the model is frozen with
+SETTINGS = ['tecnormeth', 'lowcounts', 'background', 'manualbackground', 'firsttransformlowcounts', 'contnorm',
+            'adnormalization', 'logarizedoutput', 'groups']
+
+#positive control metric each technical normalization method scales lanes to
+TECHNICALMETRIC = {'posgeomean': 'posGEOMEAN', 'regression': 'posGEOMEAN', 'Sum': 'Sum', 'Median': 'Median'}
+
+
+def altnegatives(dfgenes, n=10):
+    '''
+    Low and stably expressed genes to use as negative controls, as findaltnegatives chooses them.
+
+    :param dfgenes: lanes x genes counts
+    '''
+    genmean = dfgenes.mean()
+    genmean = genmean/np.mean(genmean)
+    genstd = dfgenes.std()/np.mean(dfgenes.mean())*2
+    genrank = (genmean*genstd).sort_values()
+    return list(genrank.head(n).index)
+
+
+def refgenesweights(eme):
+    '''Weights of reference genes in ponderaterefgenes content normalization, their geNorm M over the mean M'''
+    eme = eme.set_index('Genes')['M']
+    return eme*len(eme)/sum(eme)
+
+
+class NormalizationModel:
+    '''
+    Normalization of a reference analysis, fit() it on the reference cohort and apply() it to new lanes.
+
+    Counts tables are as in otherfiles/rawcounts.csv (genes x lanes, CodeClass and Accession columns) and
+    infolanes as in info/rawinfolanes.csv, indexed by lane.
+    '''
+    def __init__(self, settings, genes, weights=None, altnegatives=None, technicalreference=None, prenormfactor=None,
+                 calibration=None, scaler=None):
+        self.settings = {i: settings[i] for i in SETTINGS}
+        #reference genes of content normalization, and their weights for ponderaterefgenes
+        self.genes = list(genes)
+        self.weights = None if weights is None else pd.Series(weights, dtype=float)
+        #genes giving Backgroundalt
+        self.altnegatives = None if altnegatives is None else list(altnegatives)
+        self.technicalreference = technicalreference
+        self.prenormfactor = prenormfactor
+        #CalibrationModel, its reference curve corrects counts when tecnormeth is regression
+        self.calibration = calibration
+        #per gene mean and scale of standarization
+        self.scaler = scaler
+
+    @classmethod
+    def fit(cls, counts, infolanes, settings, genes, weights=None, altnegatives=None, calibration=None):
+        '''
+        Model of the reference cohort: counts of its lanes kept by QC, with their infolanes.
+
+        :param settings: args of the reference analysis, or a dict with SETTINGS
+        :param genes: reference genes of content normalization
+        '''
+        if not isinstance(settings, dict):
+            settings = {i: getattr(settings, i) for i in SETTINGS}
+        model = cls(settings, genes, weights=weights, altnegatives=altnegatives, calibration=calibration)
+
+        if settings['tecnormeth'] != 'regression':
+            model.technicalreference = float(np.mean(model.positivemetric(counts, infolanes)))
+        tnormgenes = model.technical(counts, infolanes)
+        model.prenormfactor = float(np.mean(model.geomeans(tnormgenes)))
+
+        if settings['adnormalization'] == 'standarization':
+            rnormgenes = model.content(tnormgenes)
+            mean = rnormgenes.mean(axis=1)
+            scale = rnormgenes.std(axis=1, ddof=0)
+            #StandardScaler leaves constant genes unscaled
+            scale[scale == 0] = 1
+            model.scaler = {'genes': rnormgenes.index.tolist(), 'mean': mean.tolist(), 'scale': scale.tolist()}
+        return model
+
+    def backgrounds(self, counts, infolanes):
+        '''Background of each lane of counts'''
+        if self.settings['manualbackground'] is not None:
+            return np.full(counts.shape[1] - 2, float(self.settings['manualbackground']))
+        lanes = counts.columns.drop(['CodeClass', 'Accession'])
+        if self.settings['background'] == 'Backgroundalt':
+            alt = counts.loc[self.altnegatives, lanes]
+            return (alt.mean() + alt.std()*2).to_numpy()
+        return infolanes.loc[lanes, self.settings['background']].to_numpy(dtype=float)
+
+    def positivemetric(self, counts, infolanes):
+        '''
+        Positive control metric of each lane technical normalization scales to. Positives are taken after
+        transforming low counts when firsttransformlowcounts
+        '''
+        lanes = counts.columns.drop(['CodeClass', 'Accession'])
+        pos = counts.loc[counts['CodeClass'] == 'Positive', lanes].to_numpy(dtype=float).T
+        if self.settings['firsttransformlowcounts']:
+            pos = lowcounts(pos, self.backgrounds(counts, infolanes), self.settings['lowcounts'])
+        return positivemetrics(pos)[TECHNICALMETRIC[self.settings['tecnormeth']]]
+
+    def technical(self, counts, infolanes):
+        '''Technically normalized counts, as otherfiles/tnormcounts.csv'''
+        lanes = counts.columns.drop(['CodeClass', 'Accession'])
+        if self.settings['firsttransformlowcounts']:
+            genes = counts.loc[~counts['CodeClass'].isin(['Positive', 'Negative'])]
+        else:
+            genes = counts
+
+        if self.settings['tecnormeth'] == 'regression':
+            posneg = counts.loc[counts['CodeClass'].isin(['Positive', 'Negative']), ['CodeClass'] + list(lanes)]
+            calibration = CalibrationModel.fit(posneg, reference=self.calibration)
+            values = np.column_stack([calibration.correct(str(i), genes[i]) for i in lanes])
+        else:
+            factors = self.technicalreference/self.positivemetric(counts, infolanes)
+            values = genes[lanes].to_numpy(dtype=float)*factors
+
+        tnormgenes = pd.DataFrame(values, index=genes.index, columns=lanes)
+        tnormgenes.insert(0, 'Accession', genes['Accession'])
+        tnormgenes.insert(0, 'CodeClass', genes['CodeClass'])
+        return tnormgenes
+
+    def geomeans(self, tnormgenes):
+        '''Geometric mean of the (weighted) reference genes of each lane'''
+        refgenes = tnormgenes.loc[self.genes].drop(['CodeClass', 'Accession'], axis=1)
+        if self.settings['contnorm'] == 'ponderaterefgenes':
+            refgenes = refgenes.mul(self.weights[self.genes].to_numpy(), axis=0)
+        return gmean(refgenes.to_numpy(dtype=float), axis=0)
+
+    def content(self, tnormgenes):
+        '''Content normalized counts, as results/rnormcounts.csv'''
+        normfactor = self.prenormfactor/self.geomeans(tnormgenes)
+        return tnormgenes.drop(['CodeClass', 'Accession'], axis=1)*normfactor
+
+    def additional(self, rnormgenes):
+        '''Additional normalization, as otherfiles/adnormcounts.csv'''
+        if self.settings['adnormalization'] == 'standarization':
+            mean = pd.Series(self.scaler['mean'], index=self.scaler['genes'])
+            scale = pd.Series(self.scaler['scale'], index=self.scaler['genes'])
+            return rnormgenes.sub(mean[rnormgenes.index], axis=0).div(scale[rnormgenes.index], axis=0)
+        elif self.settings['adnormalization'] == 'quantile':
+            #quantile_transform maps each lane on its own
+            return pd.DataFrame(quantile_transform(rnormgenes), index=rnormgenes.index, columns=rnormgenes.columns)
+        return rnormgenes
+
+    def logarize(self, df):
+        if self.settings['logarizedoutput'] == '2':
+            return np.log2(df)
+        elif self.settings['logarizedoutput'] == '10':
+            return np.log10(df)
+        return df
+
+    def apply(self, counts, infolanes):
+        '''
+        Normalizes the lanes in counts against the model.
+
+        :return: technically, content and additionally normalized counts and the logarized output (as rngg)
+        '''
+        tnormgenes = self.technical(counts, infolanes)
+        rnormgenes = self.content(tnormgenes)
+        adnormgenes = self.additional(rnormgenes)
+        rngg = self.logarize(rnormgenes if self.settings['groups'] == 'yes' else adnormgenes)
+        return tnormgenes, rnormgenes, adnormgenes, rngg
+
+    def todict(self):
+        return {
+            'settings': self.settings,
+            'genes': self.genes,
+            'weights': None if self.weights is None else self.weights.to_dict(),
+            'altnegatives': self.altnegatives,
+            'technicalreference': self.technicalreference,
+            'prenormfactor': self.prenormfactor,
+            'calibration': None if self.calibration is None else self.calibration.todict(),
+            'scaler': self.scaler,
+        }
+
+    @classmethod
+    def fromdict(cls, model):
+        calibration = model['calibration']
+        if calibration is not None:
+            calibration = CalibrationModel.fromdict(calibration)
+        return cls(model['settings'], model['genes'], weights=model['weights'], altnegatives=model['altnegatives'],
+                   technicalreference=model['technicalreference'], prenormfactor=model['prenormfactor'],
+                   calibration=calibration, scaler=model['scaler'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.todict(), f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.fromdict(json.load(f))
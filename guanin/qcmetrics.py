@@ -0,0 +1,122 @@
+'''
+Vectorized lane QC metrics.
+
+Every function takes a lanes x probes count array (one row per lane, probes in the same order for all
+lanes) plus the CodeClass of each probe, and computes its metrics for all lanes at once.
+'''
+import numpy as np
+import pandas as pd
+
+
+POSITIVECLASSES = ('Positive', 'Positive1', 'Positive2')
+NEGATIVECLASSES = ('Negative',)
+ENDOGENOUSCLASSES = ('Endogenous', 'Endogenous1', 'Endogenous2')
+HOUSEKEEPINGCLASSES = ('Housekeeping',)
+
+#log2 concentrations of the five highest positive controls, for R2
+LOGCONC = np.array([7, 5, 3, 1, -1], dtype=float)
+
+METRICSCOLUMNS = ['Background', 'Background2', 'Background3', 'gbb', 'nGenes', 'posGEOMEAN', 'Sum', 'Median',
+                  'R2', 'limit of detection', '0,5fm']
+
+
+def classmask(codeclass, codeclasses):
+    '''Boolean mask of the probes belonging to any of codeclasses'''
+    return np.isin(np.asarray(codeclass, dtype=object), codeclasses)
+
+
+def backgrounds(negs, trim=True, ddof=0):
+    '''
+    Background (mean + 2 std), Background2 (max) and Background3 (mean) of each lane from its negative controls.
+
+    :param negs: lanes x negatives array
+    :param trim: leave out negatives over 3 times the lane mean, as loadrccs does
+    :param ddof: std degrees of freedom
+    :return: background, background2, background3 arrays
+    '''
+    negs = np.asarray(negs, dtype=float)
+    if trim:
+        negs = np.where(negs <= 3*negs.mean(axis=1, keepdims=True), negs, np.nan)
+    background3 = np.nanmean(negs, axis=1)
+    background1 = background3 + 2*np.nanstd(negs, axis=1, ddof=ddof)
+    background2 = np.nanmax(negs, axis=1)
+    return background1, background2, background3
+
+
+def positivemetrics(pos):
+    '''
+    posGEOMEAN, Sum, Median, R2 (log2 counts of the five highest positives against LOGCONC) and
+    0,5fm (fifth highest positive) of each lane.
+
+    :param pos: lanes x positives array
+    :return: dict of arrays
+    '''
+    pos = -np.sort(-np.asarray(pos, dtype=float), axis=1)
+    logpos = np.log(pos)
+
+    top = logpos[:, :5]/np.log(2)
+    top = top - top.mean(axis=1, keepdims=True)
+    conc = LOGCONC - LOGCONC.mean()
+    r2 = (top @ conc)/np.sqrt((top*top).sum(axis=1)*(conc @ conc))
+
+    return {
+        'posGEOMEAN': np.exp(logpos.mean(axis=1)),
+        'Sum': pos.sum(axis=1),
+        'Median': np.median(pos, axis=1),
+        'R2': np.clip(r2, -1, 1),
+        '0,5fm': pos[:, 4],
+    }
+
+
+def lowcounts(counts, background, method='sustract'):
+    '''
+    Counts below background of each lane, as transformlowcounts treats them: 'asim' raises them to the background,
+    'sustract' subtracts the background from all counts (counts at or below it become 1), 'skip' keeps them.
+
+    :param counts: lanes x probes array
+    :param background: background of each lane, or a single value for all
+    :return: lanes x probes array
+    '''
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    background = np.broadcast_to(np.asarray(background, dtype=float).reshape(-1, 1), (counts.shape[0], 1))
+    if method == 'asim':
+        return np.where(counts <= background, background, counts)
+    elif method == 'sustract':
+        counts = np.where(counts <= background, 0, counts - background)
+        return np.where(counts == 0, 1, counts)
+    return counts.copy()
+
+
+def lanemetrics(counts, codeclass, lanes=None, background='Background', manualbackground=None, trim=True, ddof=0):
+    '''
+    Lane QC metrics as in infolanes, for all lanes at once.
+
+    :param counts: lanes x probes array
+    :param codeclass: CodeClass of each probe
+    :param lanes: lane names, index of the returned DataFrame
+    :param background: background used for limit of detection, unless manualbackground is given
+    :param trim: see backgrounds
+    :param ddof: see backgrounds
+    :return: DataFrame with METRICSCOLUMNS, gbb is the number of genes below Background
+    '''
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    pos = counts[:, classmask(codeclass, POSITIVECLASSES)]
+    neg = counts[:, classmask(codeclass, NEGATIVECLASSES)]
+    genes = counts[:, classmask(codeclass, POSITIVECLASSES + NEGATIVECLASSES + ENDOGENOUSCLASSES + HOUSEKEEPINGCLASSES)]
+
+    metrics = pd.DataFrame(index=lanes if lanes is not None else range(len(counts)))
+    metrics['Background'], metrics['Background2'], metrics['Background3'] = backgrounds(neg, trim=trim, ddof=ddof)
+    metrics['gbb'] = (genes < metrics['Background'].values[:, None]).sum(axis=1)
+    metrics['nGenes'] = genes.shape[1]
+    for i, j in positivemetrics(pos).items():
+        metrics[i] = j
+
+    if manualbackground is not None:
+        lodbackground = manualbackground
+    elif background in ('Background2', 'Background3'):
+        lodbackground = metrics[background]
+    else:
+        lodbackground = metrics['Background']
+    metrics['limit of detection'] = lodbackground >= metrics['0,5fm']
+
+    return metrics[METRICSCOLUMNS]
@@ -0,0 +1,334 @@
+'''Single pass reader for Nanostring RCC files, from folders or tar/zip archives'''
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import struct
+import tarfile
+import time
+import zipfile
+
+import numpy as np
+
+from .cachefolder import privatefolder
+
+
+SECTIONS = ('Header', 'Sample_Attributes', 'Lane_Attributes', 'Code_Summary')
+
+PACKMAGIC = b'GUANRCC1'
+
+ARCHIVESUFFIXES = ('.tar', '.tar.gz', '.tgz', '.zip')
+
+#typed fields from <Header>, <Sample_Attributes> and <Lane_Attributes>, anything else is kept as str
+ATTRIBUTETYPES = {
+    'FovCount': int,
+    'FovCounted': int,
+    'StagePosition': int,
+    'BindingDensity': float,
+}
+
+
+class RCC:
+    '''
+    One parsed RCC lane.
+
+    Attributes from <Header>, <Sample_Attributes> and <Lane_Attributes> are kept as dicts with typed values
+    (None for empty fields). <Code_Summary> is kept as four aligned numpy arrays.
+    '''
+    def __init__(self, header, sampleattributes, laneattributes, codeclass, names, accessions, counts):
+        self.header = header
+        self.sampleattributes = sampleattributes
+        self.laneattributes = laneattributes
+        self.codeclass = codeclass
+        self.names = names
+        self.accessions = accessions
+        self.counts = counts
+
+    @property
+    def id(self):
+        '''Sample ID, or lane ID when the sample ID is empty'''
+        sampleid = self.sampleattributes.get('ID')
+        if sampleid is None:
+            sampleid = self.laneattributes.get('ID')
+        return str(sampleid)
+
+    @property
+    def comments(self):
+        comments = self.sampleattributes.get('Comments')
+        if comments is None:
+            return 'no comments'
+        return comments
+
+    @property
+    def fovvalue(self):
+        return float(self.laneattributes['FovCounted']) / float(self.laneattributes['FovCount'])
+
+    @property
+    def bindingdensity(self):
+        return float(self.laneattributes['BindingDensity'])
+
+    def classmask(self, *codeclasses):
+        '''Boolean mask of the Code_Summary rows belonging to any of codeclasses'''
+        return np.isin(self.codeclass, codeclasses)
+
+
+def castattribute(key, value):
+    value = value.strip()
+    if value == '':
+        return None
+    cast = ATTRIBUTETYPES.get(key, str)
+    try:
+        return cast(value)
+    except ValueError:
+        return value
+
+
+def parsercc(content):
+    '''
+    Tokenises RCC content (bytes or str) in a single pass over its lines.
+
+    :param content: full RCC file content
+    :return: RCC
+    '''
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', errors='replace')
+
+    attributes = {'Header': {}, 'Sample_Attributes': {}, 'Lane_Attributes': {}}
+    codeclass = []
+    names = []
+    accessions = []
+    counts = []
+
+    section = None
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] == '<':
+            tag = line.strip('</>')
+            if line[1] == '/' or tag not in SECTIONS:
+                section = None
+            else:
+                section = tag
+            continue
+        if section is None:
+            continue
+        if section == 'Code_Summary':
+            fields = line.split(',', 3)
+            if len(fields) < 4 or fields[0] == 'CodeClass' or fields[3] == '':
+                continue
+            codeclass.append(fields[0])
+            names.append(fields[1])
+            accessions.append(fields[2])
+            counts.append(fields[3])
+        else:
+            key, _, value = line.partition(',')
+            thisattributes = attributes[section]
+            if key not in thisattributes:
+                thisattributes[key] = castattribute(key, value)
+
+    return RCC(
+        header=attributes['Header'],
+        sampleattributes=attributes['Sample_Attributes'],
+        laneattributes=attributes['Lane_Attributes'],
+        codeclass=np.array(codeclass, dtype=object),
+        names=np.array(names, dtype=object),
+        accessions=np.array(accessions, dtype=object),
+        counts=np.array(counts, dtype=float))
+
+
+def packrcc(rcc):
+    '''Compact binary form of a parsed RCC, see unpackrcc'''
+    codeclasses, codes = np.unique(rcc.codeclass.astype(str), return_inverse=True)
+    meta = json.dumps({
+        'header': rcc.header,
+        'sampleattributes': rcc.sampleattributes,
+        'laneattributes': rcc.laneattributes,
+        'codeclasses': list(codeclasses)}).encode()
+    strings = '\n'.join(list(rcc.names) + list(rcc.accessions)).encode()
+    return b''.join([
+        PACKMAGIC,
+        struct.pack('<III', len(rcc.counts), len(meta), len(strings)),
+        np.ascontiguousarray(rcc.counts, dtype='<f8').tobytes(),
+        codes.astype(np.uint8).tobytes(),
+        meta,
+        strings])
+
+
+def unpackrcc(content):
+    '''Rebuilds an RCC from packrcc output'''
+    if content[:len(PACKMAGIC)] != PACKMAGIC:
+        raise ValueError('Not a packed RCC')
+    offset = len(PACKMAGIC)
+    n, lenmeta, lenstrings = struct.unpack_from('<III', content, offset)
+    offset += 12
+    counts = np.frombuffer(content, dtype='<f8', count=n, offset=offset).astype(float)
+    offset += 8*n
+    codes = np.frombuffer(content, dtype=np.uint8, count=n, offset=offset)
+    offset += n
+    meta = json.loads(content[offset:offset + lenmeta])
+    offset += lenmeta
+    strings = content[offset:offset + lenstrings].decode().split('\n') if n else []
+    if len(strings) != 2*n:
+        raise ValueError('Corrupted packed RCC')
+    return RCC(
+        header=meta['header'],
+        sampleattributes=meta['sampleattributes'],
+        laneattributes=meta['laneattributes'],
+        codeclass=np.array(meta['codeclasses'], dtype=object)[codes],
+        names=np.array(strings[:n], dtype=object),
+        accessions=np.array(strings[n:], dtype=object),
+        counts=counts)
+
+
+class RCCCache:
+    '''
+    On-disk cache of parsed RCCs.
+
+    Entries are packrcc files named after the source path, size, mtime and content hash, so any change
+    in the RCC is a miss. Hits touch their entry and evict() removes the least recently used entries
+    once the cache grows over maxsize bytes. A folder other users can write to is not used at all (see
+    privatefolder), RCCs are parsed every time instead
+    '''
+    suffix = '.rccache'
+
+    def __init__(self, folder, maxsize=256*2**20):
+        self.folder = pathlib.Path(folder)
+        self.maxsize = maxsize
+        self.private = privatefolder(self.folder)
+        if not self.private:
+            logging.warning('RCC cache folder ' + str(self.folder) + ' is not a folder only this user can write to, not using it')
+
+    def entry(self, name, size, mtime, content):
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(str(name).encode())
+        digest.update(struct.pack('<qq', size, mtime))
+        digest.update(hashlib.blake2b(content).digest())
+        return self.folder / (digest.hexdigest() + self.suffix)
+
+    def parse(self, name, size, mtime, content):
+        '''Parsed RCC for content, from the cache when possible'''
+        if not self.private:
+            return parsercc(content)
+        entry = self.entry(name, size, mtime, content)
+        try:
+            with open(entry, 'rb') as f:
+                rcc = unpackrcc(f.read())
+            os.utime(entry)
+            return rcc
+        except (OSError, ValueError, KeyError):
+            pass
+
+        rcc = parsercc(content)
+        try:
+            tmp = entry.with_suffix('.tmp' + str(os.getpid()))
+            with open(tmp, 'wb') as f:
+                f.write(packrcc(rcc))
+            os.replace(tmp, entry)
+        except OSError as e:
+            logging.warning('Unable to write RCC cache entry ' + str(entry) + ': ' + str(e))
+        return rcc
+
+    def evict(self):
+        '''Removes least recently used entries until the cache fits in maxsize'''
+        if not self.private:
+            return
+        try:
+            entries = [(i.stat(), i) for i in self.folder.glob('*' + self.suffix)]
+        except OSError:
+            return
+        entries.sort(key=lambda x: x[0].st_mtime_ns)
+        total = sum(stat.st_size for stat, i in entries)
+        for stat, i in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                i.unlink()
+                total -= stat.st_size
+            except OSError:
+                pass
+
+
+#RCC read from an archive member, name is archive path + member name
+RCCMember = collections.namedtuple('RCCMember', ['name', 'size', 'mtime', 'content'])
+
+
+def isarchive(path):
+    return str(path).lower().endswith(ARCHIVESUFFIXES) and os.path.isfile(path)
+
+
+def rccname(file):
+    '''Lane file name for a folder entry or archive member, without directories or .gz'''
+    name = str(file).replace('\\', '/').split('/')[-1]
+    if name.lower().endswith('.gz'):
+        name = name[:-3]
+    return name
+
+
+def listrccs(folder):
+    '''
+    RCC files in folder, which can be a directory or a .tar, .tar.gz or .zip archive.
+    RCCs can be gzipped (.RCC.gz).
+
+    :return: dict of sorted file or member names to [size, mtime in ns]
+    '''
+    files = {}
+    if isarchive(folder) and zipfile.is_zipfile(folder):
+        with zipfile.ZipFile(folder) as zf:
+            for info in zf.infolist():
+                if '.RCC' in info.filename and not info.is_dir():
+                    mtime = int(time.mktime(info.date_time + (0, 0, -1)))*10**9
+                    files[info.filename] = [info.file_size, mtime]
+    elif isarchive(folder):
+        with tarfile.open(folder, 'r:*') as tar:
+            for member in tar:
+                if '.RCC' in member.name and member.isfile():
+                    files[member.name] = [member.size, int(member.mtime)*10**9]
+    else:
+        for file in os.listdir(folder):
+            if '.RCC' in file:
+                stat = os.stat(pathlib.Path(folder) / file)
+                files[file] = [stat.st_size, stat.st_mtime_ns]
+    return dict(sorted(files.items()))
+
+
+def rccsources(folder, files):
+    '''
+    What readrcc needs for each of files (from listrccs), as (file, source) pairs: paths for a directory, RCCMember
+    with the member content for archives. Archive members are read one at a time as pairs are taken, in a single
+    pass (in archive order for tars), and never extracted to disk.
+    '''
+    if not isarchive(folder):
+        for file in files:
+            yield file, pathlib.Path(folder) / file
+        return
+
+    archive = str(pathlib.Path(folder).resolve())
+    if zipfile.is_zipfile(folder):
+        with zipfile.ZipFile(folder) as zf:
+            for name in files:
+                yield name, RCCMember(archive + '/' + name, *files[name], zf.read(name))
+    else:
+        with tarfile.open(folder, 'r:*') as tar:
+            for member in tar:
+                if member.name in files and member.isfile():
+                    yield member.name, RCCMember(archive + '/' + member.name, *files[member.name], tar.extractfile(member).read())
+
+
+def readrcc(source, cache=None):
+    '''Reads and parses one RCC (a path or a RCCMember), through cache (RCCCache) if given'''
+    if isinstance(source, RCCMember):
+        name, size, mtime, content = source
+    else:
+        with open(source, 'rb') as f:
+            content = f.read()
+            stat = os.fstat(f.fileno())
+        name, size, mtime = pathlib.Path(source).resolve(), stat.st_size, stat.st_mtime_ns
+    if str(name).lower().endswith('.gz'):
+        content = gzip.decompress(content)
+    if cache is None:
+        return parsercc(content)
+    return cache.parse(name, size, mtime, content)
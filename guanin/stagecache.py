@@ -0,0 +1,161 @@
+'''
+Content-addressed cache of analysis stages.
+
+A stage key hashes the stage name, the package code, the settings the stage reads and the digests of the
+data it takes from previous stages. Entries keep what the stage produced: output files, tables it left in the
+analysis context, args attributes it set and its return value, so a stage with an unchanged key is replayed
+instead of recomputed.
+'''
+import hashlib
+import logging
+import os
+import pathlib
+import pickle
+
+import pandas as pd
+
+from .cachefolder import privatefolder
+
+
+#outputs later stages read, the only ones that count for a stage digest (reports, plots... don't)
+DATASUFFIXES = ('.csv', '.json', '.npy', '.csv.gz', '.csv.zst')
+
+
+def codedigest():
+    '''Digest of the package sources, a code change invalidates every entry'''
+    digest = hashlib.blake2b(digest_size=20)
+    for i in sorted(pathlib.Path(__file__).parent.glob('*.py')):
+        digest.update(i.read_bytes())
+    return digest.hexdigest()
+
+
+def tabledigest(table):
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((list(table.columns), str(table.index.name))).encode())
+    try:
+        hashed = pd.util.hash_pandas_object(table, index=True)
+    except TypeError:
+        #cells holding arrays or lists
+        hashed = pd.util.hash_pandas_object(table.astype(str), index=True)
+    digest.update(hashed.values.tobytes())
+    return digest.hexdigest()
+
+
+def filedigest(path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stagedigest(files, tables):
+    '''
+    Digest of the data a stage leaves to the next ones: its csv/json/npy outputs and context tables.
+
+    :param files: dict of relative path to file content
+    :param tables: dict of relative path to (table, index) as kept by AnalysisContext
+    '''
+    digest = hashlib.blake2b(digest_size=20)
+    for i in sorted(files):
+        if i.endswith(DATASUFFIXES):
+            digest.update(i.encode())
+            digest.update(files[i])
+    for i in sorted(tables):
+        digest.update(i.encode())
+        digest.update(tabledigest(tables[i][0]).encode())
+    return digest.hexdigest()
+
+
+def snapshot(folder):
+    '''{relative path: (size, mtime)} of every file under folder'''
+    files = {}
+    for root, dirs, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files[os.path.relpath(path, folder)] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+class ErrorFlag(logging.Handler):
+    '''Logging handler that records if an error was logged while attached. Stages log their errors instead of raising'''
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.raised = False
+
+    def emit(self, record):
+        self.raised = True
+
+
+class StageCache:
+    '''
+    On-disk stage entries, one pickle per key. Hits touch their entry and evict() removes the least
+    recently used entries once the cache grows over maxsize bytes. A folder other users can write to is
+    not used at all (see privatefolder)
+    '''
+    suffix = '.stage'
+
+    def __init__(self, folder, maxsize=1024*2**20):
+        self.folder = pathlib.Path(folder)
+        self.maxsize = maxsize
+        self.code = codedigest()
+        self.private = privatefolder(self.folder)
+        if not self.private:
+            logging.warning('Stage cache folder ' + str(self.folder) + ' is not a folder only this user can write to, not using it')
+
+    def key(self, stage, settings, inputs):
+        '''
+        :param settings: dict of the settings the stage reads
+        :param inputs: digests of the stage inputs (previous stage digests, external files...)
+        '''
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(repr((stage, self.code, sorted(settings.items()), list(inputs))).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        '''Entry stored for key, None if missing or unreadable'''
+        if not self.private:
+            return None
+        entry = self.folder / (key + self.suffix)
+        try:
+            with open(entry, 'rb') as f:
+                stored = pickle.load(f)
+            os.utime(entry)
+            return stored
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+
+    def put(self, key, stored):
+        if not self.private:
+            return
+        entry = self.folder / (key + self.suffix)
+        try:
+            tmp = entry.with_suffix('.tmp' + str(os.getpid()))
+            with open(tmp, 'wb') as f:
+                pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, entry)
+        except (OSError, pickle.PicklingError) as e:
+            logging.warning('Unable to write stage cache entry ' + str(entry) + ': ' + str(e))
+
+    def evict(self):
+        '''Removes least recently used entries until the cache fits in maxsize'''
+        if not self.private:
+            return
+        try:
+            entries = [(i.stat(), i) for i in self.folder.glob('*' + self.suffix)]
+        except OSError:
+            return
+        entries.sort(key=lambda x: x[0].st_mtime_ns)
+        total = sum(stat.st_size for stat, i in entries)
+        for stat, i in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                i.unlink()
+                total -= stat.st_size
+            except OSError:
+                pass
@@ -3,10 +3,31 @@ from pathlib import Path
 import tempfile
 import time
 
+from .cachefolder import usercachedir
+from .context import AnalysisContext
+
 
 class ConfigData:
     def __init__(self, *args, **kwargs):
         self.folder = Path(__file__).parent / "examples" / "d1_COV_GSE183071"
+        self.jobs = 1
+        self.rcccache = usercachedir("rcccache")
+        self.rcccachesize = 256
+        self.incremental = 'no'
+        self.loadedrccs = None
+        self.intermediateformat = 'csv'
+        self.genes = None
+        self.context = AnalysisContext()
+        self.exportintermediates = 'yes'
+        self.calibration = None
+        self.calibrationreference = None
+        self.normmodel = None
+        self.compression = 'no'
+        self.exportqueue = 8
+        self.exporter = None
+        self.stagecache = usercachedir("stagecache")
+        self.stagecachesize = 1024
+        self.stagedigests = {}
         self.minfov = 0.75
         self.maxfov = 1
         self.minbd = 0.1
@@ -30,6 +51,8 @@ class ConfigData:
         self.chooserefgenes = None
         self.filtergroupvariation = 'filterkrus'
         self.featureselectionneighbors = 4
+        self.featureselectionk = 1
+        self.featureselectiontime = None
         self.groups = 'no'
         self.numend = 9
         self.autorename = 'off'
@@ -0,0 +1,79 @@
+'''
+Binary store for the intermediate tables passed between stages (dfgenes, tnormcounts, refgenes, rngg...).
+
+Float columns are saved as a single column-major matrix in a .npy file, which is opened memory-mapped.
+The index, column labels and the other columns (CodeClass, Accession, integer or boolean columns), with
+their dtypes, go to a .json sidecar. Values are stored as they are, so tables come back with the same
+dtypes and without the round-off of a csv round trip.
+'''
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+def isfloatcolumn(column):
+    return pd.api.types.is_float_dtype(column)
+
+
+def writestore(df, path, index=True):
+    '''
+    Writes df to path.npy (float columns) and path.json (index, labels and other columns).
+
+    :param index: False if the index is not part of the table, as in to_csv(index=False)
+    '''
+    #numbers left in object columns are stored as numbers, as a csv round trip would read them
+    df = df.infer_objects()
+    floats = [position for position in range(df.shape[1]) if isfloatcolumn(df.iloc[:, position])]
+    other = [position for position in range(df.shape[1]) if position not in floats]
+    meta = {
+        'index': df.index.tolist(),
+        'indexname': df.index.name,
+        'indexdtype': str(df.index.dtype),
+        'keepindex': index,
+        'columns': df.columns.tolist(),
+        'floats': floats,
+        'other': {str(i): df.iloc[:, i].tolist() for i in other},
+        'dtypes': {str(i): str(df.dtypes.iloc[i]) for i in other},
+    }
+    matrix = np.asfortranarray(df.iloc[:, floats].to_numpy(dtype=float))
+
+    #replace both files only when fully written, readers never see half a store
+    tmp = path + '.tmp' + str(os.getpid())
+    with open(tmp + '.npy', 'wb') as f:
+        np.save(f, matrix)
+    with open(tmp + '.json', 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp + '.npy', path + '.npy')
+    os.replace(tmp + '.json', path + '.json')
+
+
+def isstore(path):
+    return os.path.isfile(path + '.json') and os.path.isfile(path + '.npy')
+
+
+def readstore(path, mmap=True):
+    '''
+    Reads a store written by writestore, returns (table, keepindex). The float block is a copy-on-write
+    memory map of path.npy, so nothing is copied until it is modified and the file itself is never changed.
+    '''
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    matrix = np.load(path + '.npy', mmap_mode='c' if mmap else None)
+
+    index = pd.Index(meta['index'], name=meta['indexname'], dtype=meta['indexdtype'])
+    columns = meta['columns']
+    df = pd.DataFrame(matrix, index=index, columns=[columns[i] for i in meta['floats']], copy=False)
+    for position, column in enumerate(columns):
+        if str(position) in meta['other']:
+            values = pd.Series(meta['other'][str(position)], index=index, dtype=meta['dtypes'][str(position)])
+            df.insert(position, column, values, allow_duplicates=True)
+    return df, meta['keepindex']
+
+
+def copystore(source, path):
+    '''Copies the store at source (path without suffix) to path'''
+    for suffix in ('.npy', '.json'):
+        shutil.copyfile(source + suffix, path + suffix)
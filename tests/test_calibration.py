@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from guanin.calibration import YMEAN, cubicroots, polyinverse
+
+
+@pytest.mark.parametrize('degree', [1, 2, 3, 4])
+def test_polyinverse_as_roots(degree):
+    rng = np.random.default_rng(degree)
+    x = np.sort(rng.uniform(5, 5000, 6))
+    poly = np.polynomial.Polynomial.fit(x, np.array(YMEAN)*rng.uniform(0.7, 1.3, 6), degree)
+    counts = rng.uniform(0.1, 8000, 300)
+    #some values have complex roots, and some roots are close to 0
+    values = poly(counts)*rng.uniform(0.5, 1.5, 300)
+    expected = [abs(min((poly - i).roots(), key=lambda x: abs(x - j))) for i, j in zip(values, counts)]
+    assert np.allclose(polyinverse(poly, values, counts), expected, rtol=1e-9, atol=1e-9)
+
+
+def test_cubicroots_repeated_and_zero():
+    #(x - 2)**3, x**3, x*(x - 1)*(x + 1), (x - 1)**2
+    roots = cubicroots([[-8, 12, -6, 1], [0, 0, 0, 1], [0, -1, 0, 1]])
+    assert np.allclose(np.sort_complex(roots), [[2, 2, 2], [0, 0, 0], [-1, 0, 1]], atol=1e-5)
+    assert np.allclose(cubicroots([[1, -2, 1]]), 1)
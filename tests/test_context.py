@@ -0,0 +1,28 @@
+import pandas as pd
+
+from guanin import guanin
+
+
+def test_runs_do_not_share_context():
+    first = guanin.argParser([])
+    first.context.put('results/table.csv', pd.DataFrame({'a': [1]}))
+    second = guanin.argParser([])
+    assert second.context is not first.context
+    assert 'results/table.csv' not in second.context
+
+    guanin.newrun(first)
+    assert 'results/table.csv' not in first.context
+
+
+def test_exported_table_copied_once(tmp_path, monkeypatch):
+    args = guanin.argParser(['-of', str(tmp_path)])
+    (tmp_path / 'results').mkdir()
+    copies = []
+    copy = pd.DataFrame.copy
+    monkeypatch.setattr(pd.DataFrame, 'copy', lambda self, *x, **y: copies.append(self) or copy(self, *x, **y))
+    table = pd.DataFrame({'a': [1.0, 2.0]})
+    guanin.writetable(table, args, 'results/table.csv')
+    guanin.flushexports(args)
+    monkeypatch.undo()
+    assert len(copies) == 1 and copies[0] is table
+    assert pd.read_csv(tmp_path / 'results' / 'table.csv', index_col=0).equals(table)
@@ -0,0 +1,39 @@
+import threading
+
+from guanin.exporter import ExportWriter
+
+
+def test_digest_function_runs_on_worker_and_skips_duplicates(tmp_path):
+    path = tmp_path / 'table.csv'
+    threads = []
+    writes = []
+
+    def digest():
+        threads.append(threading.current_thread())
+        return 'content'
+
+    def write(x):
+        writes.append(x)
+        with open(x, 'w') as f:
+            f.write('content')
+
+    exporter = ExportWriter()
+    exporter.submit(path, write, digest=digest)
+    exporter.flush()
+    exporter.submit(path, write, digest=digest)
+    exporter.flush()
+    assert len(threads) == 2 and threading.current_thread() not in threads
+    assert len(writes) == 1
+
+    #changed on disk, written again
+    path.write_text('other')
+    exporter.submit(path, write, digest=digest)
+    exporter.flush()
+    assert len(writes) == 2
+    assert path.read_text() == 'content'
+
+    #same content elsewhere is copied
+    exporter.submit(tmp_path / 'copy.csv', write, digest=digest)
+    exporter.flush()
+    assert len(writes) == 2
+    assert (tmp_path / 'copy.csv').read_text() == 'content'
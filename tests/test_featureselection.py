@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from guanin import featureselection
+
+
+def data():
+    rng = np.random.default_rng(5)
+    X = rng.poisson(30, (40, 30))
+    y = rng.integers(0, 3, 40)
+    #continuous, distances between samples don't tie
+    return np.log2(X + rng.random(X.shape)), y
+
+
+def test_as_mlxtend():
+    mlxtend = pytest.importorskip('mlxtend.feature_selection')
+    from sklearn.neighbors import KNeighborsClassifier
+    X, y = data()
+    subsets = featureselection.backwardselection(X, y, 4)
+    sfs = mlxtend.SequentialFeatureSelector(KNeighborsClassifier(4), k_features=1, forward=False, floating=False,
+                                            scoring='balanced_accuracy', cv=2).fit(X, y)
+    for i, j in sfs.subsets_.items():
+        assert subsets[i]['feature_idx'] == j['feature_idx']
+        assert np.allclose(subsets[i]['cv_scores'], j['cv_scores'])
+
+
+def test_small_blocks_and_pool(monkeypatch):
+    X, y = data()
+    subsets = featureselection.backwardselection(X, y, 4)
+    monkeypatch.setattr(featureselection, 'BLOCKSIZE', 1)
+    monkeypatch.setattr(featureselection, 'POOLSIZE', 0)
+    pooled = featureselection.backwardselection(X, y, 4, jobs=2)
+    for i, j in subsets.items():
+        assert pooled[i]['feature_idx'] == j['feature_idx']
+        assert np.array_equal(pooled[i]['cv_scores'], j['cv_scores'])
@@ -0,0 +1,46 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from guanin.genes import GeneCatalogue
+
+
+def counts():
+    names = pd.Index(['g' + str(i) for i in range(6)], name='Name')
+    return pd.DataFrame({'CodeClass': ['Endogenous', 'Housekeeping', 'Positive', 'Negative', 'Endogenous', 'Positive'],
+                         'Accession': list('abcdef'), 'lane': np.arange(6.0)}, index=names)
+
+
+def test_index_names_compared_once(monkeypatch):
+    table = counts()
+    genes = GeneCatalogue.fromcounts(table)
+    assert genes.sameas(table.drop(columns='Accession'))
+
+    compared = []
+    monkeypatch.setattr(np, 'array_equal', lambda *x: compared.append(x))
+    assert genes.forcounts(table[['CodeClass', 'lane']]) is genes
+    assert not compared
+
+
+def test_derived_catalogue_reused():
+    table = counts()
+    genes = GeneCatalogue.fromcounts(table)
+    subset = table.iloc[[4, 2, 0]]
+    derived = genes.forcounts(subset)
+    assert derived is not genes and not genes.sameas(subset)
+    assert list(derived.names) == ['g4', 'g2', 'g0']
+    assert genes.forcounts(subset) is derived
+    assert list(derived.kind('Positive')) == [1]
+
+    #same genes, new index, compared again
+    assert genes.forcounts(counts()) is genes
+
+
+def test_pickled_without_known_indexes():
+    table = counts()
+    genes = GeneCatalogue.fromcounts(table)
+    genes.forcounts(table.iloc[:2])
+    loaded = pickle.loads(pickle.dumps(genes))
+    assert loaded.indexes == {}
+    assert loaded.sameas(table)
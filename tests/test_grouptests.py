@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+from guanin.grouptests import kruskal, ranksums
+
+
+@pytest.mark.parametrize('sizes', [(17, 18, 2), (3, 3), (5, 7, 9), (1, 40), (2, 2, 2, 2)])
+def test_kruskal_constant_genes(sizes):
+    samples = [np.full((i, 3), 7.0) for i in sizes]
+    for i in samples:
+        i[:, 1] = 0.5
+    h, pvalue = kruskal(samples)
+    assert np.isnan(h).all()
+    assert np.isnan(pvalue).all()
+
+
+def test_kruskal_constant_gene_among_others():
+    rng = np.random.default_rng(1)
+    samples = [rng.poisson(20, (i, 4)).astype(float) for i in (17, 18, 2)]
+    for i in samples:
+        i[:, 2] = 3
+    h, pvalue = kruskal(samples)
+    assert np.isnan(h[2]) and np.isnan(pvalue[2])
+    assert np.isfinite(h[[0, 1, 3]]).all()
+
+
+def test_kruskal_as_scipy():
+    rng = np.random.default_rng(0)
+    samples = [rng.poisson(5, (i, 50)).astype(float) for i in (6, 9, 4)]
+    h, pvalue = kruskal(samples)
+    for j in range(50):
+        expected = stats.kruskal(*[i[:, j] for i in samples])
+        assert h[j] == pytest.approx(expected.statistic)
+        assert pvalue[j] == pytest.approx(expected.pvalue)
+
+
+def test_ranksums_as_scipy():
+    rng = np.random.default_rng(0)
+    x = rng.poisson(5, (8, 50)).astype(float)
+    y = rng.poisson(6, (11, 50)).astype(float)
+    z, pvalue = ranksums(x, y)
+    for j in range(50):
+        expected = stats.ranksums(x[:, j], y[:, j])
+        assert z[j] == pytest.approx(expected.statistic)
+        assert pvalue[j] == pytest.approx(expected.pvalue)
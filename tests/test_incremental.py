@@ -0,0 +1,28 @@
+import json
+import logging
+import pathlib
+import shutil
+
+from guanin import guanin
+
+
+EXAMPLES = pathlib.Path(__file__).parent.parent / 'examples' / 'd1_COV_GSE183071'
+
+
+def test_missing_intermediates_warn_and_load_all(tmp_path, caplog):
+    rccs = tmp_path / 'rccs'
+    rccs.mkdir()
+    for i in sorted(EXAMPLES.glob('*.RCC'))[:3]:
+        shutil.copy(i, rccs)
+    args = guanin.argParser(['-f', str(rccs), '-of', str(tmp_path / 'output'), '-inc', 'yes', '-ei', 'no', '-rc', ''])
+    args.start_time = 0
+    #a previous load of the first RCC whose intermediate tables were not written
+    (tmp_path / 'output' / 'otherfiles').mkdir(parents=True)
+    first = dict(list(guanin.listrccs(rccs).items())[:1])
+    loaded = dict(guanin.loadsettings(args), files={i: j + ['lane'] for i, j in first.items()})
+    (tmp_path / 'output' / 'otherfiles' / 'loadedrccs.json').write_text(json.dumps(loaded))
+
+    with caplog.at_level(logging.WARNING):
+        infolanes = guanin.loadnewrccs(args)[0]
+    assert len(infolanes) == 3
+    assert any('--exportintermediates yes' in i.message for i in caplog.records)
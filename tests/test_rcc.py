@@ -0,0 +1,66 @@
+import pathlib
+import tarfile
+import zipfile
+
+import pytest
+
+from guanin import guanin
+from guanin.rcc import RCCCache, RCCMember, listrccs, rccsources
+
+
+EXAMPLES = pathlib.Path(__file__).parent.parent / 'examples' / 'd1_COV_GSE183071'
+
+
+def parse(cache):
+    rcc = sorted(EXAMPLES.glob('*.RCC'))[0]
+    stat = rcc.stat()
+    return cache.parse(str(rcc), stat.st_size, stat.st_mtime_ns, rcc.read_bytes())
+
+
+def test_cache_hit(tmp_path):
+    cache = RCCCache(tmp_path / 'cache')
+    parsed = parse(cache)
+    assert len(list(cache.folder.glob('*' + cache.suffix))) == 1
+    assert (parse(cache).counts == parsed.counts).all()
+
+
+def test_shared_cache_folder_is_not_used(tmp_path):
+    folder = tmp_path / 'cache'
+    folder.mkdir(mode=0o777)
+    folder.chmod(0o777)
+    cache = RCCCache(folder)
+    assert not cache.private
+    assert len(parse(cache).counts)
+    assert not list(folder.iterdir())
+
+
+def archives(tmp_path):
+    '''The first RCCs of the examples as a folder, a tar.gz and a zip, with reversed member order'''
+    rccs = sorted(EXAMPLES.glob('*.RCC'))[:4]
+    with tarfile.open(tmp_path / 'rccs.tar.gz', 'w:gz') as tar:
+        for i in rccs[::-1]:
+            tar.add(i, arcname=i.name)
+    with zipfile.ZipFile(tmp_path / 'rccs.zip', 'w') as zf:
+        for i in rccs[::-1]:
+            zf.write(i, arcname=i.name)
+    return [EXAMPLES, tmp_path / 'rccs.tar.gz', tmp_path / 'rccs.zip']
+
+
+def test_archive_members_are_read_lazily(tmp_path):
+    for folder in archives(tmp_path)[1:]:
+        sources = rccsources(folder, listrccs(folder))
+        name, member = next(sources)
+        assert isinstance(member, RCCMember) and member.name.endswith(name)
+        assert len(list(sources)) == 3
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_lanes_from_archives(tmp_path, jobs):
+    args = guanin.argParser(['-j', str(jobs), '-rc', ''])
+    loaded = []
+    for folder in archives(tmp_path):
+        files = dict(list(listrccs(folder).items())[:4])
+        loaded.append(guanin.maplanes(folder, files, args))
+    for lanes in loaded[1:]:
+        assert [i['ID'] for i in lanes] == [i['ID'] for i in loaded[0]]
+        assert all((i['counts'] == j['counts']).all() for i, j in zip(lanes, loaded[0]))
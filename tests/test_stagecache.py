@@ -0,0 +1,83 @@
+import os
+import pathlib
+import shutil
+
+from guanin import guanin
+from guanin.stagecache import StageCache
+
+
+EXAMPLES = pathlib.Path(__file__).parent.parent / 'examples' / 'd1_COV_GSE183071'
+
+
+def rccstage(tmp_path, folder):
+    '''Stage fingerprinting folder as runQCview does, and the list its runs are appended to'''
+    runs = []
+
+    @guanin.stage('rccstage', ['folder'], inputs=guanin.rccfolderdigest)
+    def run(args):
+        runs.append(args.folder)
+
+    args = guanin.argParser(['-f', folder, '-of', str(tmp_path / 'output'), '-sc', str(tmp_path / 'cache')])
+    return run, args, runs
+
+
+def test_relative_folder_change_misses(tmp_path, monkeypatch):
+    rccs = tmp_path / 'rccs'
+    rccs.mkdir()
+    for i in sorted(EXAMPLES.glob('*.RCC'))[:2]:
+        shutil.copy(i, rccs)
+    #relative to the package, as getfolderpath takes it, and not to the working directory
+    monkeypatch.chdir(tmp_path)
+    folder = os.path.relpath(rccs, pathlib.Path(guanin.__file__).parent)
+    run, args, runs = rccstage(tmp_path, folder)
+
+    run(args)
+    run(args)
+    assert len(runs) == 1
+
+    rcc = sorted(rccs.iterdir())[0]
+    rcc.write_text(rcc.read_text().replace('<Code_Summary>', '<Code_Summary>\n', 1))
+    run(args)
+    assert len(runs) == 2
+
+
+def test_cache_folder_is_private(tmp_path):
+    cache = StageCache(tmp_path / 'cache')
+    assert cache.private
+    assert (cache.folder.stat().st_mode & 0o777) == 0o700
+    cache.put('key', {'result': 1})
+    assert cache.get('key') == {'result': 1}
+
+
+def test_shared_cache_folder_is_not_read(tmp_path):
+    folder = tmp_path / 'cache'
+    StageCache(folder).put('key', {'result': 1})
+    folder.chmod(0o777)
+    cache = StageCache(folder)
+    assert not cache.private
+    assert cache.get('key') is None
+
+
+def test_compression_change_misses(tmp_path):
+    runs = []
+
+    @guanin.stage('storestage', guanin.STORESETTINGS)
+    def run(args):
+        runs.append(args.compression)
+
+    for compression in ['no', 'no', 'gzip']:
+        run(guanin.argParser(['-cmp', compression, '-of', str(tmp_path / 'output'), '-sc', str(tmp_path / 'cache')]))
+    assert runs == ['no', 'gzip']
+
+
+def test_runs_do_not_share_stage_digests(tmp_path):
+    @guanin.stage('firststage', [])
+    def run(args):
+        pass
+
+    first = guanin.argParser(['-of', str(tmp_path / 'output'), '-sc', str(tmp_path / 'cache')])
+    run(first)
+    assert 'firststage' in first.stagedigests
+    assert 'firststage' not in guanin.argParser([]).stagedigests
+    guanin.newrun(first)
+    assert not first.stagedigests